@@ -1,160 +1,1406 @@
 import argparse
-import uiautomator2 as u2
+import atexit
+import collections
+import csv
+import functools
+import gzip
+import http.server
+import json
+import os
+import queue
+import shlex
+import shutil
+import signal
+import sqlite3
+import sys
 import logging
+import logging.handlers
+import threading
 import traceback
 import time
+import re
+import subprocess
+import urllib.parse
+import weakref
+import xml.etree.ElementTree as ET
+
+try:
+    import uiautomator2 as u2
+except ImportError:
+    # Only needed to drive a real phone, the offline replay backend in FFSReplay.py runs without it
+    u2 = None
 
 # Constants
 ANDROID_SERIAL = "4fe9718b"
 SAVED_WIFI_SSID = "test-xxzhkcgj"
 DEFAULT_DEVICE_NAME = "Second plug"
 MAXIMUM_TEST_COUNT = 30
+LOG_MAX_MB = 100
+LOG_BACKUP_COUNT = 20
 ALEXA_APP_PACKAGE_NAME = "com.amazon.dee.app"
+ALEXA_HOME_ANCHOR = {"resourceId": "com.amazon.dee.app:id/home_header_quick_add"}
+WARM_START_MAX_BACK_PRESSES = 5
 
 # Logger setup
 logger = logging.getLogger(__name__)
 
-def setup_logging(mode):
-    logger.setLevel(logging.INFO)
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-    time_str = time.strftime("%Y-%m-%d_%H_%M_%S", time.localtime())
-    handler = logging.FileHandler(f"log_{mode}_{time_str}.txt")
+# Per-thread context of the worker driving a phone
+_worker = threading.local()
+
+class WorkerContextFilter(logging.Filter):
+    def filter(self, record):
+        record.serial = getattr(_worker, "serial", "-")
+        return True
+
+class WorkerSerialFilter(logging.Filter):
+    def __init__(self, serial):
+        super().__init__()
+        self.serial = serial
+
+    def filter(self, record):
+        # Runs on the listener thread, so rely on the serial stamped by WorkerContextFilter
+        return getattr(record, "serial", None) == self.serial
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        return json.dumps({
+            "time": round(record.created, 3),
+            "level": record.levelname,
+            "serial": getattr(record, "serial", "-"),
+            "message": record.getMessage(),
+        })
+
+def gzip_rotator(source, dest):
+    with open(source, "rb") as f_in, gzip.open(dest, "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+def gzip_namer(name):
+    return name + ".gz"
+
+def make_log_file_handler(path, formatter, max_mb, rotate_when):
+    if rotate_when:
+        handler = logging.handlers.TimedRotatingFileHandler(path, when=rotate_when, backupCount=LOG_BACKUP_COUNT)
+    else:
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_mb * 1024 * 1024, backupCount=LOG_BACKUP_COUNT)
+    # Rotated segments are compressed on the listener thread
+    handler.rotator = gzip_rotator
+    handler.namer = gzip_namer
     handler.setLevel(logging.INFO)
     handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    return handler
+
+def setup_logging(mode, serials=None, log_format="text", max_mb=LOG_MAX_MB, rotate_when=None):
+    logger.setLevel(logging.INFO)
+    logger.addFilter(WorkerContextFilter())
+    multi_phone = serials is not None and len(serials) > 1
+    if multi_phone:
+        formatter = logging.Formatter('%(asctime)s - %(serial)s - %(levelname)s - %(message)s')
+    else:
+        formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
+    formats = []
+    if log_format in ("text", "both"):
+        formats.append(("txt", formatter))
+    if log_format in ("json", "both"):
+        formats.append(("jsonl", JsonLogFormatter()))
+
+    time_str = time.strftime("%Y-%m-%d_%H_%M_%S", time.localtime())
+    handlers = []
+    for extension, file_formatter in formats:
+        handlers.append(make_log_file_handler(f"log_{mode}_{time_str}.{extension}", file_formatter, max_mb, rotate_when))
+        # One extra log stream per phone when several phones run in parallel
+        if multi_phone:
+            for serial in serials:
+                worker_handler = make_log_file_handler(f"log_{mode}_{serial}_{time_str}.{extension}", file_formatter, max_mb, rotate_when)
+                worker_handler.addFilter(WorkerSerialFilter(serial))
+                handlers.append(worker_handler)
     console = logging.StreamHandler()
     console.setLevel(logging.INFO)
-    logger.addHandler(console)
+    if multi_phone:
+        console.setFormatter(logging.Formatter('[%(serial)s] %(message)s'))
+    handlers.append(console)
+
+    # The test threads only enqueue records, disk and console I/O happen on the listener thread
+    log_queue = queue.Queue(-1)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+# Hierarchy snapshots
+SNAPSHOT_MAX_AGE_SEC = 1.0
+# Taps trust a cached snapshot only when it was just taken, e.g. by the wait that found the element,
+# since the app can move elements by itself in between
+TAP_SNAPSHOT_MAX_AGE_SEC = 0.2
+
+# Selector keys as used by uiautomator2, mapped to the hierarchy dump attributes
+SELECTOR_ATTRIBUTES = {
+    "resourceId": "resource-id",
+    "text": "text",
+    "description": "content-desc",
+    "className": "class",
+}
+
+_XPATH_STEP = re.compile(r'(//|/)([\w.*]+)((?:\[[^\]]*\])*)')
+_XPATH_PREDICATE = re.compile(r'\[(?:@([\w-]+)="([^"]*)"|(\d+))\]')
+_BOUNDS = re.compile(r'\[(-?\d+),(-?\d+)\]\[(-?\d+),(-?\d+)\]')
+
+class UISnapshot:
+    def __init__(self, xml):
+        self.root = ET.fromstring(xml)
+        self.taken_at = time.time()
+        self.parents = {}
+        self.index = {attr: {} for attr in ("resource-id", "text", "content-desc")}
+        for parent in self.root.iter():
+            for child in parent:
+                self.parents[child] = parent
+            for attr, values in self.index.items():
+                value = parent.get(attr)
+                if value:
+                    values.setdefault(value, []).append(parent)
+
+    def find(self, selector):
+        # selector is either a uiautomator2 style dict or an xpath string
+        if isinstance(selector, str):
+            return self.xpath(selector)
+        candidates = None
+        for key in ("resourceId", "text", "description"):
+            if key in selector:
+                candidates = self.index[SELECTOR_ATTRIBUTES[key]].get(selector[key], [])
+                break
+        if candidates is None:
+            candidates = [node for node in self.root.iter() if node is not self.root]
+        return [node for node in candidates if self._matches(node, selector)]
+
+    def _matches(self, node, selector):
+        for key, value in selector.items():
+            if key == "textContains":
+                if value not in node.get("text", ""):
+                    return False
+            elif key == "scrollable":
+                if (node.get("scrollable") == "true") != value:
+                    return False
+            elif node.get(SELECTOR_ATTRIBUTES[key]) != value:
+                return False
+        return True
 
-# UI interaction functions
-def ui_click(device, resId, expected_resId=None, timeout_sec=10):
-    device(resourceId=resId).click()
-    logger.info(f"Clicked on resourceId={resId}, expecting={expected_resId}, timeout={timeout_sec}")
-    if not device(resourceId=expected_resId).wait(timeout=timeout_sec):
-        logger.error("Failed to get the expected page")
-        return False
-    return True
+    def exists(self, selector):
+        return len(self.find(selector)) > 0
+
+    def get_text(self, selector):
+        nodes = self.find(selector)
+        return nodes[0].get("text") if nodes else None
+
+    def center(self, selector):
+        nodes = self.find(selector)
+        if not nodes:
+            return None
+        match = _BOUNDS.match(nodes[0].get("bounds", ""))
+        if not match:
+            return None
+        x1, y1, x2, y2 = (int(v) for v in match.groups())
+        return (x1 + x2) // 2, (y1 + y2) // 2
+
+    def xpath(self, expr):
+        # Supports the subset used by the flows: '//' and '/' steps, '*' or class names,
+        # [@attr="value"] and positional [n] predicates
+        context = [self.root]
+        for axis, test, predicates in _XPATH_STEP.findall(expr):
+            groups = []
+            for node in context:
+                parents = node.iter() if axis == '//' else [node]
+                for parent in parents:
+                    groups.append([child for child in parent if test == '*' or child.get("class") == test])
+            context = []
+            for group in groups:
+                for attr, value, position in _XPATH_PREDICATE.findall(predicates):
+                    if position:
+                        group = group[int(position) - 1:int(position)]
+                    else:
+                        group = [child for child in group if child.get(attr) == value]
+                context.extend(group)
+        return context
+
+_snapshots = weakref.WeakKeyDictionary()
+
+def take_snapshot(device, refresh=False, max_age_sec=SNAPSHOT_MAX_AGE_SEC):
+    snap = _snapshots.get(device)
+    if refresh or snap is None or time.time() - snap.taken_at > max_age_sec:
+        snap = UISnapshot(device.dump_hierarchy())
+        _snapshots[device] = snap
+    return snap
+
+def invalidate_snapshot(device):
+    _snapshots.pop(device, None)
+
+# Multi-outcome waits
+WAIT_DONE = "done"
+WAIT_ERROR = "error"
+WAIT_TIMEOUT = "timeout"
+WAIT_POLL_INTERVAL_SEC = 0.5
+
+UGS_ERROR_SELECTORS = [
+    {"resourceId": "UGS_ErrorPage"},
+]
+MATTER_ERROR_SELECTORS = [
+    {"resourceId": "mosaic.base_text", "text": "Is this device set up for control with another assistant or app?"},
+]
+
+def wait_for_any(device, conditions, timeout):
+    # conditions: list of (outcome, selector, present), all evaluated against one snapshot per pass
+    deadline = time.time() + timeout
+    refresh = False
+    while True:
+        snap = take_snapshot(device, refresh=refresh)
+        for outcome, selector, present in conditions:
+            if snap.exists(selector) == present:
+                return outcome
+        if time.time() >= deadline:
+            return WAIT_TIMEOUT
+        time.sleep(WAIT_POLL_INTERVAL_SEC)
+        refresh = True
+
+def wait_phase(device, progress=None, success=(), errors=(), timeout=150):
+    timeout = phase_timeout(timeout)
+    conditions = [(WAIT_ERROR, selector, True) for selector in errors]
+    conditions += [(WAIT_DONE, selector, True) for selector in success]
+    if progress is not None:
+        conditions.append((WAIT_DONE, progress, False))
+    outcome = wait_for_any(device, conditions, timeout)
+    if outcome == WAIT_ERROR:
+        _worker.failure_class = FAILURE_DUT
+        logger.error("Error page detected, stop waiting.")
+    elif outcome == WAIT_TIMEOUT:
+        logger.error(f"Timed out after {timeout}s.")
+    return outcome
 
-def ui_click_id_with_text(device, resId, textstr, expected_resId=None, timeout_sec=10):
-    device(resourceId=resId, text=textstr).click()
-    logger.info(f"Clicked on resourceId={resId}, text={textstr}, expecting={expected_resId}, timeout={timeout_sec}")
-    if not device(resourceId=expected_resId).wait(timeout=timeout_sec):
-        logger.error("Failed to get the expected page")
-        return False
-    return True
+# UI interaction functions
+def ui_exists(device, selector):
+    return take_snapshot(device).exists(selector)
+
+def ui_wait(device, selector, timeout_sec=10):
+    return wait_for_any(device, [(WAIT_DONE, selector, True)], timeout_sec) == WAIT_DONE
+
+def ui_wait_gone(device, selector, timeout_sec=10):
+    return wait_for_any(device, [(WAIT_DONE, selector, False)], timeout_sec) == WAIT_DONE
+
+def ui_tap(device, selector):
+    # Tap by the coordinates from the snapshot when the element is already known,
+    # otherwise let uiautomator2 wait for it and click
+    point = take_snapshot(device, max_age_sec=TAP_SNAPSHOT_MAX_AGE_SEC).center(selector)
+    if point is not None:
+        device.click(*point)
+    elif isinstance(selector, str):
+        device.xpath(selector).click()
+    else:
+        device(**selector).click()
+    invalidate_snapshot(device)
+
+def tap_until(device, selector, success=(), gone=None, errors=(), timeout_sec=10):
+    ui_tap(device, selector)
+    return wait_phase(device, progress=gone, success=success, errors=errors, timeout=timeout_sec) == WAIT_DONE
+
+# Condition-driven settling
+report_saved_time = False
+
+def wait_hierarchy_stable(device, timeout_sec):
+    # The UI is considered settled once two consecutive dumps are identical
+    deadline = time.time() + timeout_sec
+    last_xml = None
+    while True:
+        xml = device.dump_hierarchy()
+        _snapshots[device] = UISnapshot(xml)
+        if xml == last_xml:
+            return True
+        if time.time() >= deadline:
+            return False
+        last_xml = xml
+        time.sleep(WAIT_POLL_INTERVAL_SEC)
+
+def note_saved_time(name, seconds):
+    saved_time = getattr(_worker, "saved_time", None)
+    if saved_time is not None:
+        saved_time[name] = saved_time.get(name, 0.0) + seconds
+
+def settle(device, name, baseline_sec, until=(), gone=None, timeout_sec=None):
+    # Stands in for a fixed time.sleep(baseline_sec): returns as soon as any selector in `until`
+    # is shown, `gone` disappears, or (with neither) the hierarchy stops changing
+    if timeout_sec is None:
+        timeout_sec = max(10, baseline_sec * 3)
+    start = time.time()
+    if until or gone is not None:
+        conditions = [(WAIT_DONE, selector, True) for selector in until]
+        if gone is not None:
+            conditions.append((WAIT_DONE, gone, False))
+        ready = wait_for_any(device, conditions, timeout_sec) == WAIT_DONE
+    else:
+        ready = wait_hierarchy_stable(device, timeout_sec)
+    elapsed = time.time() - start
+    note_saved_time(name, baseline_sec - elapsed)
+    if not ready:
+        logger.warning(f"UI not ready after {elapsed:.1f}s ({name}), continuing")
+    return ready
 
 def connect_device(serial):
+    if u2 is None:
+        raise RuntimeError("uiautomator2 is not installed, run 'pip install uiautomator2'")
     logger.info("Connecting to device...")
     device = u2.connect_usb(serial)
     logger.info(device.info)
     logger.info("Connected to phone")
     return device
 
+class DeviceSession:
+    def __init__(self, serial):
+        self.serial = serial
+        self.device = None
+        self.reconnects = 0
+        self.recycles = 0
+
+    def is_healthy(self):
+        try:
+            self.device.info
+            return True
+        except Exception:
+            logger.warning(f"Health check of {self.serial} failed")
+            return False
+
+    def get(self):
+        # Keep one uiautomator2 connection for the whole run, reconnect only when it stops answering
+        if self.device is not None and self.is_healthy():
+            return self.device
+        if self.device is not None:
+            self.reconnects += 1
+            count_metric("ffs_reconnects_total", serial=self.serial)
+            logger.warning(f"Reconnecting to {self.serial} (reconnect #{self.reconnects})")
+        self.device = connect_device(self.serial)
+        if metrics is not None:
+            self.device = InstrumentedDevice(self.device)
+        return self.device
+
+    def recycle(self):
+        # Stops the uiautomator server on the phone and drops the connection, the next get() starts both afresh
+        if self.device is None:
+            return
+        self.recycles += 1
+        logger.info(f"Recycling the uiautomator session of {self.serial} (recycle #{self.recycles})")
+        try:
+            stop_uiautomator = getattr(self.device, "stop_uiautomator", None)
+            if stop_uiautomator is not None:
+                stop_uiautomator()
+        except Exception:
+            logger.warning(f"Could not stop uiautomator on {self.serial}: {traceback.format_exc(limit=1).strip()}")
+        invalidate_snapshot(self.device)
+        self.device = None
+
+warm_start_enabled = False
+
 def restart_alexa_app(device):
     logger.info("Restarting Alexa App...")
     device.app_stop(ALEXA_APP_PACKAGE_NAME)
     device.app_start(ALEXA_APP_PACKAGE_NAME)
+    invalidate_snapshot(device)
     logger.info("Waiting for Alexa App to load...")
-    time.sleep(6)
+    settle(device, "app_launch", 6, until=[ALEXA_HOME_ANCHOR, {"resourceId": "FullScreenTakeover::PrimaryButton"}], timeout_sec=30)
+
+def return_to_alexa_home(device):
+    try:
+        if device.app_current().get("package") != ALEXA_APP_PACKAGE_NAME:
+            return False
+        for _ in range(WARM_START_MAX_BACK_PRESSES):
+            if ui_exists(device, ALEXA_HOME_ANCHOR):
+                logger.info("Alexa App is on the home screen")
+                return True
+            device.press("back")
+            invalidate_snapshot(device)
+            if ui_wait(device, ALEXA_HOME_ANCHOR, 2):
+                logger.info("Navigated back to the Alexa home screen")
+                return True
+            if device.app_current().get("package") != ALEXA_APP_PACKAGE_NAME:
+                return False
+        return False
+    except Exception:
+        logger.error("Could not navigate back to the home screen")
+        logger.error(traceback.format_exc())
+        return False
+
+def open_alexa_app(device):
+    # Warm start goes back to the home screen of the running app, cold start kills and relaunches it
+    if warm_start_enabled and return_to_alexa_home(device):
+        return
+    restart_alexa_app(device)
 
 def log_error_info(device):
+    _worker.failure_class = FAILURE_DUT
     try:
-        error_info = device(resourceId="UGS_ErrorPage").get_text()
+        error_info = take_snapshot(device, refresh=True).get_text({"resourceId": "UGS_ErrorPage"})
+        if error_info is None:
+            logger.error("Could not retrieve error info")
+            return
+        _worker.error_text = error_info
         logger.error(f'Error info: {error_info}')
     except Exception:
         logger.error("Could not retrieve error info")
         logger.error(traceback.format_exc())
 
 def log_error_info_for_matter(device):
+    _worker.failure_class = FAILURE_DUT
     try:
-        error_info = device(resourceId="mosaic.base_text").get_text()
+        error_info = take_snapshot(device, refresh=True).get_text({"resourceId": "mosaic.base_text"})
+        if error_info is None:
+            logger.error("Could not retrieve error info")
+            return
+        _worker.error_text = error_info
         logger.error(f'Info about last page: {error_info}')
     except Exception:
         logger.error("Could not retrieve error info")
         logger.error(traceback.format_exc())
 
+# Popup handling
+POPUP_WATCH_INTERVAL_SEC = 1.0
+
+popup_watcher_enabled = True
+
+# Overlays that may interrupt any flow, dismissed by tapping the matched element
+KNOWN_POPUPS = [
+    ("lts_card", {"resourceId": "FullScreenTakeover::PrimaryButton"}),
+    ("later_prompt", {"text": "LATER"}),
+    ("app_not_responding", {"resourceId": "android:id/aerr_wait"}),
+]
+
+class PopupWatcher:
+    def __init__(self, device, serial, popups=KNOWN_POPUPS, interval_sec=POPUP_WATCH_INTERVAL_SEC):
+        self.device = device
+        self.serial = serial
+        self.popups = popups
+        self.interval_sec = interval_sec
+        self.counts = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f"popup-watcher-{self.serial}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        _worker.serial = self.serial
+        while not self._stop.wait(self.interval_sec):
+            try:
+                self.dismiss_popups()
+            except Exception:
+                logger.warning(f"Popup watcher check failed: {traceback.format_exc(limit=1).strip()}")
+
+    def dismiss_popups(self):
+        # Shares the snapshot cache with the flow, so most checks cost no extra RPC
+        snap = take_snapshot(self.device)
+        for name, selector in self.popups:
+            point = snap.center(selector)
+            if point is None:
+                continue
+            self.device.click(*point)
+            invalidate_snapshot(self.device)
+            self.counts[name] += 1
+            count_metric("ffs_popups_dismissed_total", popup=name)
+            logger.info(f"Dismissed popup '{name}' (seen {self.counts[name]} times)")
+            return
+
 def handle_lts_card(device):
+    # A running popup watcher already takes care of the card
+    if getattr(_worker, "popup_watcher", None) is not None:
+        return
     try:
-        if device.exists(resourceId="FullScreenTakeover::PrimaryButton"):
-            device(resourceId="FullScreenTakeover::PrimaryButton").click()
-            device(resourceId="FullScreenTakeover::PrimaryButton").wait_gone(2)
-        if device.exists(text="LATER"):
-            device(text="LATER").click()
-            device(text="LATER").wait_gone(2)
-        pass
+        for name, selector in KNOWN_POPUPS:
+            if ui_exists(device, selector):
+                ui_tap(device, selector)
+                ui_wait_gone(device, selector, 2)
+                count_metric("ffs_popups_dismissed_total", popup=name)
     except Exception:
         logger.error("Could not handle lts card")
         logger.error(traceback.format_exc())
 
-# Test functions
-def execute_test_ugs(device, saved_wifi_ssid):
+# Logcat streaming
+ADB_PATH = "adb"
+# Lines reporting a failure ("not found", "no devices discovered", ...) must not count as the device showing up
+ZTS_LOGCAT_PATTERN = (r"(?i)^(?!.*\b(not|no|none|unable|fail\w*|lost|disconnected|removed)\b)"
+                      r".*((added|discovered|found).*{device_name}|{device_name}.*(added|discovered|found))")
+
+zts_detect_mode = "ui"
+zts_logcat_pattern = ZTS_LOGCAT_PATTERN
+zts_logcat_tags = []
+
+def zts_logcat_regex(device_name):
+    return re.compile(zts_logcat_pattern.replace("{device_name}", re.escape(device_name)))
+
+def device_epoch(serial):
+    # Logcat timestamps follow the phone clock, which can be off from the host clock
     try:
-        logger.info("Starting UGS test...")
-        restart_alexa_app(device)
-        handle_lts_card(device)
-        
-        logger.info("Clicking button '+' ...")
-        if not ui_click(device, "com.amazon.dee.app:id/home_header_quick_add", "1-primary", 10):
-            logger.error("Unable to see the add device menu.")
-            return False
+        result = subprocess.run([ADB_PATH, "-s", serial, "shell", "date", "+%s.%N"],
+                                capture_output=True, text=True, errors="replace", timeout=10)
+        seconds, _, fraction = result.stdout.strip().partition(".")
+        # Older toybox builds print %N as is
+        return float(f"{seconds}.{fraction}") if fraction.isdigit() else float(seconds)
+    except Exception:
+        logger.warning(f"Could not read the clock of {serial}, using the host clock: {traceback.format_exc(limit=1).strip()}")
+        return time.time()
+
+class LogcatWatcher:
+    def __init__(self, serial, pattern, prefilter=None, tags=None):
+        self.serial = serial
+        self.pattern = pattern
+        self.prefilter = prefilter.lower() if prefilter is not None else None
+        self.tags = tags if tags is not None else zts_logcat_tags
+        self.matched_at = None
+        self.matched_line = None
+        self.lines_seen = 0
+        self._matched = threading.Event()
+        self._process = None
+        self._thread = None
+
+    def start(self):
+        # Starts the stream at the current phone time, so buffered lines logged before now are not parsed
+        cmd = [ADB_PATH, "-s", self.serial, "logcat", "-v", "time", "-T", f"{device_epoch(self.serial):.3f}"]
+        if self.tags:
+            cmd += [f"{tag}:V" for tag in self.tags] + ["*:S"]
+        self._process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                         text=True, errors="replace", bufsize=1)
+        self._thread = threading.Thread(target=self._read, name=f"logcat-{self.serial}", daemon=True)
+        self._thread.start()
+
+    def _read(self):
+        for line in self._process.stdout:
+            self.lines_seen += 1
+            # A plain substring test drops almost every line before the regex runs
+            if self.prefilter is not None and self.prefilter not in line.lower():
+                continue
+            if self.pattern.search(line):
+                self.matched_at = time.time()
+                self.matched_line = line.strip()
+                self._matched.set()
+                return
+
+    def wait(self, timeout_sec):
+        return self._matched.wait(timeout_sec)
+
+    def stop(self):
+        if self._process is not None and self._process.poll() is None:
+            self._process.terminate()
+            try:
+                self._process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+
+# Failure artifacts
+ARTIFACT_DIR = "artifacts"
+ARTIFACT_QUEUE_DEPTH = 8
+ARTIFACT_WORKERS = 2
+ARTIFACT_DISK_BUDGET_MB = 500
+LOGCAT_TAIL_LINES = 2000
+LOGCAT_WINDOW_SEC = 300
+
+artifact_pipeline = None
+
+class ArtifactPipeline:
+    def __init__(self, root, disk_budget_bytes, queue_depth=ARTIFACT_QUEUE_DEPTH, workers=ARTIFACT_WORKERS):
+        self.root = root
+        self.disk_budget_bytes = disk_budget_bytes
+        self.queue = queue.Queue(maxsize=queue_depth)
+        self.dropped = 0
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        # Oldest first, so eviction pops from the left
+        self.entries = collections.deque(sorted(
+            ((entry.path, directory_size(entry.path)) for entry in os.scandir(root) if entry.is_dir()),
+            key=lambda item: os.path.getmtime(item[0])))
+        self.total_bytes = sum(size for _, size in self.entries)
+        self.threads = [threading.Thread(target=self._run, name=f"artifacts-{n}", daemon=True) for n in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def capture(self, device, serial, mode, iteration, step):
+        # Runs on the test thread: only grabs what the next iteration would overwrite,
+        # everything else happens on the workers
+        job = {
+            "serial": serial,
+            "mode": mode,
+            "iteration": iteration,
+            "step": step,
+            "captured_at": time.time(),
+            # The logcat is read later by a worker, so remember where the failure is in the phone's log
+            "logcat_until": device_epoch(serial),
+        }
+        try:
+            job["screenshot"] = device.screenshot(format="raw")
+        except Exception:
+            logger.warning(f"Could not take screenshot: {traceback.format_exc(limit=1).strip()}")
+        try:
+            job["hierarchy"] = device.dump_hierarchy()
+        except Exception:
+            logger.warning(f"Could not dump hierarchy: {traceback.format_exc(limit=1).strip()}")
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            self.dropped += 1
+            logger.warning(f"Artifact queue full, dropped artifacts of iteration {iteration} ({self.dropped} dropped so far)")
+
+    def close(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            try:
+                self._write(job)
+            except Exception:
+                logger.error("Could not write failure artifacts")
+                logger.error(traceback.format_exc())
+
+    def _write(self, job):
+        time_str = time.strftime("%Y-%m-%d_%H_%M_%S", time.localtime(job["captured_at"]))
+        path = os.path.join(self.root, f"{job['mode']}_{job['serial']}_{job['iteration']:05d}_{time_str}")
+        os.makedirs(path, exist_ok=True)
+        if job.get("screenshot"):
+            # Screenshots are already compressed images
+            with open(os.path.join(path, "screenshot.jpg"), "wb") as f:
+                f.write(job["screenshot"])
+        if job.get("hierarchy"):
+            with gzip.open(os.path.join(path, "hierarchy.xml.gz"), "wt", encoding="utf-8") as f:
+                f.write(job["hierarchy"])
+        logcat = read_logcat_window(job["serial"], job["logcat_until"], LOGCAT_WINDOW_SEC, LOGCAT_TAIL_LINES)
+        if logcat:
+            with gzip.open(os.path.join(path, "logcat.txt.gz"), "wt", encoding="utf-8") as f:
+                f.write(logcat)
+        info = {key: job[key] for key in ("serial", "mode", "iteration", "step", "captured_at")}
+        with open(os.path.join(path, "info.json"), "w") as f:
+            json.dump(info, f, indent=2)
+        logger.info(f"Failure artifacts written to {path}")
+        self._evict(path, directory_size(path))
+
+    def _evict(self, path, size):
+        with self.lock:
+            self.entries.append((path, size))
+            self.total_bytes += size
+            while self.total_bytes > self.disk_budget_bytes and len(self.entries) > 1:
+                old_path, old_size = self.entries.popleft()
+                shutil.rmtree(old_path, ignore_errors=True)
+                self.total_bytes -= old_size
+                logger.info(f"Evicted {old_path} to stay within the artifact disk budget")
+
+def directory_size(path):
+    return sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+
+def read_logcat_window(serial, until, window_sec, max_lines):
+    # The last max_lines lines logged before until (phone time), skipping what the next iteration logged since
+    try:
+        result = subprocess.run([ADB_PATH, "-s", serial, "logcat", "-d", "-v", "epoch", "-t", f"{until - window_sec:.3f}"],
+                                capture_output=True, text=True, errors="replace", timeout=30)
+    except Exception:
+        logger.warning(f"Could not read logcat: {traceback.format_exc(limit=1).strip()}")
+        return None
+    lines = []
+    for line in result.stdout.splitlines(keepends=True):
+        stamp = line.split(None, 1)[0] if line.strip() else ""
+        try:
+            if float(stamp) > until:
+                continue
+        except ValueError:
+            # "--------- beginning of main" and other lines without a timestamp
+            pass
+        lines.append(line)
+    return "".join(lines[-max_lines:])
+
+# Results store
+RESULTS_DB = "ffs_results.db"
+
+results_store = None
+
+class ResultStore:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS iterations (
+            id INTEGER PRIMARY KEY,
+            run_id TEXT NOT NULL,
+            started_at REAL NOT NULL,
+            mode TEXT NOT NULL,
+            serial TEXT,
+            dut TEXT,
+            iteration INTEGER,
+            outcome TEXT NOT NULL,
+            failing_step TEXT,
+            error_text TEXT,
+            duration REAL,
+            failure_class TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_iterations_mode_time ON iterations (mode, started_at, outcome, duration);
+        CREATE INDEX IF NOT EXISTS idx_iterations_mode_step ON iterations (mode, outcome, started_at, failing_step, duration);
+        CREATE INDEX IF NOT EXISTS idx_iterations_time ON iterations (started_at, outcome, duration);
+        CREATE TABLE IF NOT EXISTS steps (
+            id INTEGER PRIMARY KEY,
+            run_id TEXT NOT NULL,
+            started_at REAL NOT NULL,
+            mode TEXT,
+            dut TEXT,
+            step TEXT NOT NULL,
+            outcome TEXT NOT NULL,
+            duration REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_steps_phase ON steps (mode, dut, step, outcome, started_at, duration);
+    """
+
+    def __init__(self, path, run_id=None):
+        self.path = path
+        self.run_id = run_id
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        # Databases written before failures were classified
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(iterations)")]
+        if "failure_class" not in columns:
+            self.conn.execute("ALTER TABLE iterations ADD COLUMN failure_class TEXT")
+        self.lock = threading.Lock()
+
+    def record_iteration(self, started_at, mode, serial, dut, iteration, outcome, failing_step, error_text, duration, failure_class=None):
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO iterations (run_id, started_at, mode, serial, dut, iteration, outcome, failing_step, error_text, duration, failure_class) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (self.run_id, started_at, mode, serial, dut, iteration, outcome, failing_step, error_text, duration, failure_class))
+            self.conn.commit()
+
+    def record_step(self, started_at, mode, dut, step, outcome, duration):
+        # Committed together with the iteration row
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO steps (run_id, started_at, mode, dut, step, outcome, duration) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self.run_id, started_at, mode, dut, step, outcome, duration))
+
+    def recent_step_durations(self, mode, dut, step, limit):
+        rows = self.query(
+            "SELECT duration FROM steps WHERE mode = ? AND dut IS ? AND step = ? AND outcome = 'ok' "
+            "ORDER BY started_at DESC LIMIT ?", (mode, dut, step, limit))
+        return [row[0] for row in reversed(rows)]
+
+    def query(self, sql, params=()):
+        with self.lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    def close(self):
+        with self.lock:
+            # Steps recorded after the last iteration row, e.g. of its factory reset
+            self.conn.commit()
+            self.conn.close()
+
+# Grouping column of the query subcommand
+QUERY_GROUPS = {
+    "step": "failing_step",
+    "day": "date(started_at, 'unixepoch', 'localtime')",
+    "serial": "serial",
+    "dut": "dut",
+    "mode": "mode",
+    "error": "error_text",
+    "class": "failure_class",
+}
+
+def query_results(store, mode=None, days=7, by="step"):
+    where = ["started_at >= ?"]
+    params = [time.time() - days * 86400]
+    if mode:
+        where.append("mode = ?")
+        params.append(mode)
+    where_sql = " AND ".join(where)
+    total = store.query(f"SELECT COUNT(*) FROM iterations WHERE {where_sql}", params)[0][0]
+    group = QUERY_GROUPS[by]
+    if by in ("step", "error", "class"):
+        # Failures are attributed to the step (or error) they ended in, rates are relative to all iterations
+        rows = store.query(
+            f"SELECT {group}, COUNT(*), AVG(duration) FROM iterations WHERE {where_sql} AND outcome = 'fail' "
+            f"GROUP BY {group} ORDER BY COUNT(*) DESC", params)
+        return total, [(key, total, failures, failures / total if total else 0.0, avg) for key, failures, avg in rows]
+    rows = store.query(
+        f"SELECT {group}, COUNT(*), SUM(outcome = 'fail'), AVG(duration) FROM iterations WHERE {where_sql} "
+        f"GROUP BY {group} ORDER BY {group}", params)
+    return total, [(key, count, failures, failures / count if count else 0.0, avg) for key, count, failures, avg in rows]
+
+def query_main(argv):
+    parser = argparse.ArgumentParser(prog="FFSAutomation.py query", description="Query the results of previous runs.")
+    parser.add_argument('--db', type=str, default=RESULTS_DB, help='The results database.')
+    parser.add_argument('--mode', type=str, default=None, help='Only count iterations of this test mode.')
+    parser.add_argument('--days', type=float, default=7, help='Only count iterations of the last N days.')
+    parser.add_argument('--by', type=str, default="step", choices=sorted(QUERY_GROUPS), help='Group the failure rate by this column.')
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.db):
+        print(f"No results database at {args.db}")
+        return
+    store = ResultStore(args.db)
+    start = time.time()
+    total, rows = query_results(store, args.mode, args.days, args.by)
+    elapsed_ms = (time.time() - start) * 1000
+    store.close()
+
+    print(f"{args.mode or 'All modes'}, last {args.days:g} days: {total} iterations ({elapsed_ms:.1f} ms)")
+    print(f"  {args.by:<40} {'iterations':>10} {'failures':>9} {'rate':>7} {'avg s':>8}")
+    for key, count, failures, rate, avg in rows:
+        avg_str = f"{avg:8.1f}" if avg is not None else f"{'-':>8}"
+        print(f"  {str(key):<40.40} {count:>10} {failures:>9} {rate:>7.1%} {avg_str}")
+
+# Adaptive timeouts
+ADAPTIVE_TIMEOUT_MARGIN = 2.0
+ADAPTIVE_TIMEOUT_FLOOR_SEC = 20
+ADAPTIVE_TIMEOUT_MIN_SAMPLES = 20
+ADAPTIVE_TIMEOUT_HISTORY = 500
+
+phase_timeouts = None
+
+class PhaseTimeouts:
+    def __init__(self, store=None, margin=ADAPTIVE_TIMEOUT_MARGIN, floor_sec=ADAPTIVE_TIMEOUT_FLOOR_SEC, pinned=None, adaptive=True):
+        self.store = store
+        self.adaptive = adaptive
+        self.margin = margin
+        self.floor_sec = floor_sec
+        self.pinned = pinned or {}
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def _samples(self, key):
+        # Seeded from the results database on first use, then kept up to date by observe()
+        if key not in self.samples:
+            history = self.store.recent_step_durations(*key, ADAPTIVE_TIMEOUT_HISTORY) if self.store is not None else []
+            self.samples[key] = collections.deque(history, maxlen=ADAPTIVE_TIMEOUT_HISTORY)
+        return self.samples[key]
+
+    def observe(self, mode, dut, step, outcome, duration):
+        if not self.adaptive or outcome != "ok":
+            return
+        with self.lock:
+            self._samples((mode, dut, step)).append(duration)
+
+    def timeout(self, mode, dut, step, static_sec):
+        # p99 of the successful runs of this phase times a margin, between the floor and the static value
+        if step in self.pinned:
+            return self.pinned[step]
+        if not self.adaptive:
+            return static_sec
+        with self.lock:
+            samples = list(self._samples((mode, dut, step)))
+        if len(samples) < ADAPTIVE_TIMEOUT_MIN_SAMPLES:
+            return static_sec
+        return min(static_sec, max(self.floor_sec, percentile(samples, 99) * self.margin))
+
+def parse_pinned_timeouts(values):
+    pinned = {}
+    for value in values:
+        step, _, seconds = value.partition('=')
+        pinned[step.strip()] = float(seconds)
+    return pinned
+
+def phase_timeout(static_sec):
+    # Timeout for a wait of the current step
+    step = getattr(_worker, "step", None)
+    if phase_timeouts is None or step is None:
+        return static_sec
+    timeout = phase_timeouts.timeout(getattr(_worker, "flow", None), getattr(_worker, "dut", None), step[0], static_sec)
+    if timeout != static_sec:
+        logger.info(f"Using a timeout of {timeout:.1f}s for {step[0]} (static {static_sec}s)")
+    return timeout
+
+# Live metrics
+METRICS_PHASE_BUCKETS = (0.5, 1, 2, 5, 10, 20, 30, 60, 90, 120, 180, 300)
+METRICS_ITERATION_BUCKETS = (30, 60, 120, 180, 240, 300, 450, 600, 900, 1200)
+
+# name -> (type, help), rendered in this order
+METRIC_DEFINITIONS = {
+    "ffs_start_time_seconds": ("gauge", "Unix time the run started."),
+    "ffs_iterations_total": ("counter", "Finished iterations by mode and outcome."),
+    "ffs_failures_total": ("counter", "Failed iterations by mode and failure class."),
+    "ffs_iteration_duration_seconds": ("histogram", "Wall time of an iteration, factory reset excluded."),
+    "ffs_phase_duration_seconds": ("histogram", "Duration of the flow steps by mode, step and outcome."),
+    "ffs_step_retries_total": ("counter", "UI step attempts repeated by the retry policy."),
+    "ffs_device_calls_total": ("counter", "uiautomator2 device calls by method; UI object operations count once as 'selector'."),
+    "ffs_reconnects_total": ("counter", "Reconnects to a phone after a failed health check."),
+    "ffs_popups_dismissed_total": ("counter", "Popups dismissed by the popup watcher or the flows."),
+}
+
+metrics = None
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return "{" + ",".join(f'{name}="{escape(value)}"' for name, value in labels) + "}"
+
+class Metrics:
+    # Updates only take a lock around a few additions, so the test loop never waits on a scrape
+    def __init__(self):
+        self.values = collections.defaultdict(float)
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] += value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, buckets, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [buckets, [0] * len(buckets), 0.0, 0]
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    histogram[1][i] += 1
+            histogram[2] += value
+            histogram[3] += 1
+
+    def render(self):
+        with self.lock:
+            values = dict(self.values)
+            histograms = {key: (h[0], list(h[1]), h[2], h[3]) for key, h in self.histograms.items()}
+        lines = []
+        for name, (kind, help_text) in METRIC_DEFINITIONS.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind != "histogram":
+                for (metric, labels), value in sorted(values.items()):
+                    if metric == name:
+                        lines.append(f"{name}{format_labels(labels)} {float(value)!r}")
+                continue
+            for (metric, labels), (buckets, counts, total, count) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, bucket_count in zip(buckets, counts):
+                    lines.append(f"{name}_bucket{format_labels(labels + (('le', f'{float(bound)!r}'),))} {bucket_count}")
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {count}")
+                lines.append(f"{name}_sum{format_labels(labels)} {total!r}")
+                lines.append(f"{name}_count{format_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+def count_metric(name, value=1, **labels):
+    if metrics is not None:
+        metrics.inc(name, value, **labels)
+
+def observe_metric(name, value, buckets, **labels):
+    if metrics is not None:
+        metrics.observe(name, value, buckets, **labels)
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode("utf-8") if metrics is not None else b""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"metrics: {format % args}")
+
+def start_metrics_server(host, port):
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logger.info(f"Serving metrics on http://{host}:{server.server_port}/metrics")
+    return server
+
+class InstrumentedDevice:
+    # Counts the calls made on a uiautomator2 device for ffs_device_calls_total
+    def __init__(self, device):
+        self._device = device
+
+    def __getattr__(self, name):
+        attr = getattr(self._device, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+        def call(*args, **kwargs):
+            count_metric("ffs_device_calls_total", method=name)
+            return attr(*args, **kwargs)
+        return call
+
+    def __call__(self, **selector):
+        count_metric("ffs_device_calls_total", method="selector")
+        return self._device(**selector)
+
+# Step timing
+STEP_HISTORY_SIZE = 10000
+
+step_recorder = None
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    rank = max(1, int(round(pct / 100 * len(ordered))))
+    return ordered[min(rank, len(ordered)) - 1]
+
+class StepRecorder:
+    def __init__(self, path, max_mb=None, rotate_when=None):
+        self.path = path
+        self.file = None
+        self.handler = None
+        if max_mb or rotate_when:
+            # Soaks roll the records over like the log files instead of growing one file forever
+            self.handler = make_log_file_handler(path, logging.Formatter("%(message)s"), max_mb, rotate_when)
+        else:
+            self.file = open(path, "a")
+        self.durations = {}
+        self.lock = threading.Lock()
+
+    def record(self, entry):
+        with self.lock:
+            if self.handler is not None:
+                self.handler.handle(logging.makeLogRecord({"msg": json.dumps(entry), "levelno": logging.INFO, "levelname": "INFO"}))
+            else:
+                self.file.write(json.dumps(entry) + "\n")
+                self.file.flush()
+            # Attempts that were retried are kept in the file but left out of the percentiles
+            if entry["outcome"] == "retry":
+                return
+            key = (entry["mode"], entry["step"])
+            if key not in self.durations:
+                self.durations[key] = collections.deque(maxlen=STEP_HISTORY_SIZE)
+            self.durations[key].append(entry["duration"])
+
+    def close(self):
+        with self.lock:
+            if self.handler is not None:
+                self.handler.close()
+            else:
+                self.file.close()
 
-        logger.info("Clicking button 'Add Device' ...")
-        if not ui_click(device, "1-primary", "AddDevicesLandingPage", 10):
-            logger.error("Unable to see the AddDevicesLandingPage.")
-            return False
+    def log_report(self):
+        with self.lock:
+            durations = {key: list(values) for key, values in self.durations.items()}
+        logger.info(f"=======================================================")
+        logger.info(f" Step latency report (seconds), records in {self.path}:")
+        for mode in dict.fromkeys(mode for mode, _ in durations):
+            logger.info(f" {mode}:")
+            for (step_mode, step), values in durations.items():
+                if step_mode != mode:
+                    continue
+                logger.info(f"   {step:<30} n={len(values):<5} p50={percentile(values, 50):8.2f} p90={percentile(values, 90):8.2f} p99={percentile(values, 99):8.2f}")
+        logger.info(f"=======================================================")
 
-        logger.info("Scrolling down to find 'Development Device' ...")
-        device(scrollable=True).scroll.to(text="Development Device")
-        logger.info("Clicking 'Development Device' ...")
-        if not ui_click(device, "DeviceTypeRow_Development Device-primary", "DiscoveryBrandSelectionPage", 10):
-            logger.error("Unable to see the DiscoveryBrandSelectionPage.")
+def record_step(step, start, duration, outcome):
+    mode = getattr(_worker, "flow", None)
+    dut = getattr(_worker, "dut", None)
+    if results_store is not None:
+        results_store.record_step(start, mode, dut, step, outcome, duration)
+    if phase_timeouts is not None:
+        phase_timeouts.observe(mode, dut, step, outcome, duration)
+    observe_metric("ffs_phase_duration_seconds", duration, METRICS_PHASE_BUCKETS, mode=mode, step=step, outcome=outcome)
+    if step_recorder is None:
+        return
+    step_recorder.record({
+        "step": step,
+        "mode": mode,
+        "start": round(start, 3),
+        "duration": round(duration, 3),
+        "outcome": outcome,
+        "iteration": getattr(_worker, "iteration", None),
+        "serial": getattr(_worker, "serial", None),
+    })
+
+def end_step(outcome):
+    step = getattr(_worker, "step", None)
+    if step is None:
+        return
+    _worker.step = None
+    name, start = step
+    _worker.last_step = name
+    record_step(name, start, time.time() - start, outcome)
+
+def begin_step(name):
+    end_step("ok")
+    _worker.step = (name, time.time())
+
+def timed_flow(mode):
+    # The last step still open when the flow returns takes the flow's outcome,
+    # so a failing flow records the step it failed in
+    def decorator(flow):
+        @functools.wraps(flow)
+        def wrapper(*args, **kwargs):
+            _worker.flow = mode
+            _worker.step = None
+            start = time.time()
+            result = False
+            try:
+                result = flow(*args, **kwargs)
+            finally:
+                outcome = "ok" if result else "fail"
+                end_step(outcome)
+                record_step("total", start, time.time() - start, outcome)
+            return result
+        return wrapper
+    return decorator
+
+# Step retries
+FAILURE_DUT = "dut"
+FAILURE_AUTOMATION = "automation"
+RETRY_BACKOFF_SEC = 1.0
+
+step_retry_attempts = 3
+
+class RetryPolicy:
+    def __init__(self, attempts=None, backoff_sec=RETRY_BACKOFF_SEC, done=None, rollback=None):
+        # done: a page name or selectors showing that the step took effect and must not be repeated
+        # rollback: page to navigate back to before the next attempt
+        self.attempts = attempts
+        self.backoff_sec = backoff_sec
+        self.done = done
+        self.rollback = rollback
+
+def step_took_effect(device, done):
+    if done is None:
+        return False
+    snap = take_snapshot(device, refresh=True)
+    if isinstance(done, str):
+        return detect_page(snap) == done
+    return any(snap.exists(selector) for selector in done)
+
+def retry_step(device, step, action, policy):
+    # Retries a UI action that returned False or raised. Failures marked as DUT failures are not retried,
+    # everything left over after the last attempt is an automation failure.
+    attempts = policy.attempts if policy.attempts is not None else step_retry_attempts
+    for attempt in range(1, attempts + 1):
+        _worker.failure_class = None
+        try:
+            if action():
+                return True
+        except Exception:
+            logger.warning(f"{step} failed: {traceback.format_exc(limit=1).strip()}")
+        if _worker.failure_class == FAILURE_DUT or attempt == attempts:
+            break
+        # The failed attempt is recorded on its own, so it neither passes for a successful step nor
+        # swallows the rollback steps
+        end_step("retry")
+        time.sleep(policy.backoff_sec * 2 ** (attempt - 1))
+        if step_took_effect(device, policy.done):
+            logger.info(f"{step} took effect after all, not repeating it")
+            return True
+        if policy.rollback is not None:
+            if not navigate_to(device, policy.rollback):
+                break
+        begin_step(step)
+        _worker.retries = getattr(_worker, "retries", 0) + 1
+        count_metric("ffs_step_retries_total", mode=getattr(_worker, "flow", None), step=step)
+        logger.warning(f"Retrying {step} ({attempt + 1}/{attempts})")
+    if _worker.failure_class is None:
+        _worker.failure_class = FAILURE_AUTOMATION
+    return False
+
+# Page navigation
+NAVIGATION_STEP_TIMEOUT_SEC = 10
+
+# Pages of the add device flows, recognised when all anchors are on screen.
+# Checked in order, so pages sharing anchors list the more specific one first.
+PAGES = [
+    ("add_menu", [{"resourceId": "1-primary"}]),
+    ("home", [ALEXA_HOME_ANCHOR]),
+    ("add_landing", [{"resourceId": "AddDevicesLandingPage"}]),
+    ("brand_selection", [{"resourceId": "DiscoveryBrandSelectionPage"}]),
+    ("ack_code_choice", [{"resourceId": "mosaic.pages.InstructionalPage-title"}, {"resourceId": "mosaic.base_text", "text": "Don't Have A Code?"}]),
+    ("ack_power_check", [{"resourceId": "mosaic.pages.InstructionalPage-title"}, {"resourceId": "mosaic.base_text", "text": "Yes"}]),
+    ("ugs_pairing_mode", [{"resourceId": "mosaic.pages.InstructionalPage-title"}, {"resourceId": "mosaic.pages.InstructionalPage-footer-primary-btn"}]),
+    ("matter_grid", [{"resourceId": "mosaic-tiles_grid_0_genericMatter"}]),
+    ("matter_logo", [{"resourceId": "mosaic.base_text", "text": "Does your device have a Matter logo?"}]),
+    ("matter_power_check", [{"resourceId": "power-on-check-footer-primary-btn"}]),
+    ("matter_locate_qr", [{"resourceId": "locate-qr-code-page-footer-secondary-btn"}]),
+    ("matter_locate_numeric", [{"resourceId": "locate-numerical-code-page-footer-primary-btn"}]),
+    ("matter_input_code", [{"resourceId": "input-numeric-code-page-BodyText"}]),
+]
+
+def tap_action(selector):
+    return lambda device: ui_tap(device, selector)
+
+def scroll_tap_action(selector, text=None):
+    # Scrolls to the row by its text, or to the end of the list when the text is not reliable
+    def action(device):
+        if not ui_exists(device, selector):
+            if text is not None:
+                device(scrollable=True).scroll.to(text=text)
+                invalidate_snapshot(device)
+            else:
+                device(scrollable=True).scroll.toEnd()
+                invalidate_snapshot(device)
+                settle(device, "scroll_to_end", 3, until=[selector])
+        ui_tap(device, selector)
+    return action
+
+# (from page, to page, step name, action)
+PAGE_TRANSITIONS = [
+    ("home", "add_menu", "open_add_menu", tap_action({"resourceId": "com.amazon.dee.app:id/home_header_quick_add"})),
+    ("add_menu", "add_landing", "open_add_device", tap_action({"resourceId": "1-primary"})),
+    ("add_landing", "brand_selection", "select_development_device",
+     scroll_tap_action({"resourceId": "DeviceTypeRow_Development Device-primary"}, "Development Device")),
+    ("add_landing", "matter_grid", "select_other", scroll_tap_action({"resourceId": "DeviceTypeRow_Other-primary"})),
+    ("brand_selection", "ack_power_check", "select_ack", tap_action({"resourceId": "DeviceBrandRow_ACK=0-primary"})),
+    ("ack_power_check", "ack_code_choice", "confirm_powered_on", tap_action({"resourceId": "mosaic.base_text", "text": "Yes"})),
+    ("ack_code_choice", "ugs_pairing_mode", "choose_ugs", tap_action({"resourceId": "mosaic.base_text", "text": "Don't Have A Code?"})),
+    ("matter_grid", "matter_logo", "select_matter", tap_action({"resourceId": "mosaic-tiles_grid_0_genericMatter"})),
+    ("matter_logo", "matter_power_check", "confirm_matter_logo", tap_action({"resourceId": "mosaic.base_text", "text": "YES"})),
+    ("matter_power_check", "matter_locate_qr", "confirm_powered_on", tap_action({"resourceId": "power-on-check-footer-primary-btn"})),
+    ("matter_locate_qr", "matter_locate_numeric", "choose_numeric_code", tap_action({"resourceId": "locate-qr-code-page-footer-secondary-btn"})),
+    ("matter_locate_numeric", "matter_input_code", "open_code_input", tap_action({"resourceId": "locate-numerical-code-page-footer-primary-btn"})),
+]
+
+def detect_page(snap):
+    for name, anchors in PAGES:
+        if all(snap.exists(anchor) for anchor in anchors):
+            return name
+    return None
+
+def current_page(device):
+    if device.app_current().get("package") != ALEXA_APP_PACKAGE_NAME:
+        return None
+    return detect_page(take_snapshot(device))
+
+def wait_page(device, page, timeout_sec):
+    deadline = time.time() + timeout_sec
+    refresh = False
+    while True:
+        if detect_page(take_snapshot(device, refresh=refresh)) == page:
+            return True
+        if time.time() >= deadline:
             return False
-
-        logger.info("Clicking 'ACK' ...")
-        if not ui_click(device, "DeviceBrandRow_ACK=0-primary", "mosaic.pages.InstructionalPage-title", 10):
-            logger.error("Unable to see the InstructionalPage.")
+        time.sleep(WAIT_POLL_INTERVAL_SEC)
+        refresh = True
+
+def wait_known_page(device, timeout_sec):
+    # Waits for any page of PAGES after a launch, which can end on a popup. A popup watcher on the
+    # device clears it by itself, otherwise the popup is dismissed inline; never both, since two taps
+    # on the same spot would hit whatever is under the popup once it closes
+    watcher = getattr(_worker, "popup_watcher", None)
+    dismiss_popups = watcher is None or watcher.device is not device
+    deadline = time.time() + timeout_sec
+    refresh = False
+    while True:
+        snap = take_snapshot(device, refresh=refresh)
+        page = detect_page(snap)
+        if page is not None:
+            return page
+        for name, selector in KNOWN_POPUPS if dismiss_popups else ():
+            point = snap.center(selector)
+            if point is not None:
+                device.click(*point)
+                invalidate_snapshot(device)
+                ui_wait_gone(device, selector, 2)
+                count_metric("ffs_popups_dismissed_total", popup=name)
+                logger.info(f"Dismissed popup '{name}'")
+                break
+        if time.time() >= deadline:
+            return None
+        time.sleep(WAIT_POLL_INTERVAL_SEC)
+        refresh = True
+
+def take_transition(device, action, to_page):
+    action(device)
+    return wait_page(device, to_page, NAVIGATION_STEP_TIMEOUT_SEC)
+
+def find_path(source, target):
+    # Breadth-first search over PAGE_TRANSITIONS, returns the transitions to take or None
+    paths = {source: []}
+    pending = collections.deque([source])
+    while pending:
+        page = pending.popleft()
+        if page == target:
+            return paths[page]
+        for transition in PAGE_TRANSITIONS:
+            if transition[0] == page and transition[1] not in paths:
+                paths[transition[1]] = paths[page] + [transition]
+                pending.append(transition[1])
+    return None
+
+def navigate_to(device, target):
+    # Resumes from the page on screen and only (re)starts the app when there is no way forward from it
+    page = current_page(device)
+    path = find_path(page, target) if page is not None else None
+    if path is None:
+        begin_step("restart_app")
+        open_alexa_app(device)
+        page = wait_known_page(device, NAVIGATION_STEP_TIMEOUT_SEC)
+        path = find_path(page, target) if page is not None else None
+        if path is None:
+            logger.error(f"No way from the page {page} to {target}.")
+            _worker.failure_class = FAILURE_AUTOMATION
             return False
-
-        logger.info("Clicking 'Yes' to confirm device is powered on ...")
-        if not ui_click_id_with_text(device, "mosaic.base_text", "Yes", "mosaic.pages.InstructionalPage-title", 10):
-            logger.error("Unable to see the InstructionalPage (UGS/BCS).")
+    if path:
+        logger.info(f"Navigating {' -> '.join([page] + [transition[1] for transition in path])}")
+    for from_page, to_page, step, action in path:
+        begin_step(step)
+        logger.info(f"{step}: expecting the page {to_page} ...")
+        policy = RetryPolicy(done=to_page, rollback=from_page)
+        if not retry_step(device, step, functools.partial(take_transition, device, action, to_page), policy):
+            logger.error(f"Unable to see the page {to_page}.")
             return False
+    return True
 
-        logger.info("Clicking 'Don't Have A Code?' to confirm using UGS ...")
-        if not ui_click_id_with_text(device, "mosaic.base_text", "Don't Have A Code?", "mosaic.pages.InstructionalPage-title", 10):
+# Test functions
+@timed_flow("UGS")
+def execute_test_ugs(device, saved_wifi_ssid):
+    try:
+        logger.info("Starting UGS test...")
+        if not navigate_to(device, "ugs_pairing_mode"):
             logger.error("Unable to see the InstructionalPage (pairing mode prompt).")
             return False
 
+        begin_step("confirm_next")
         logger.info("Clicking 'Next' to continue ...")
-        if not ui_click(device, "mosaic.pages.InstructionalPage-footer-primary-btn", "mosaic.pages.ConfirmationPage-title", 10):
+        confirmation_page = [{"resourceId": "mosaic.pages.ConfirmationPage-title"}]
+        if not retry_step(device, "confirm_next",
+                          lambda: tap_until(device, {"resourceId": "mosaic.pages.InstructionalPage-footer-primary-btn"}, confirmation_page, errors=UGS_ERROR_SELECTORS),
+                          RetryPolicy(done=confirmation_page, rollback="ugs_pairing_mode")):
             logger.error("Unable to see the ConfirmationPage.")
             return False
 
+        begin_step("looking_for_device")
         logger.info("Looking for the device ...")
-        if not device(resourceId="mosaic.base_text", text="Looking for your ACK development device").wait_gone(timeout=150):
+        if wait_phase(device, progress={"resourceId": "mosaic.base_text", "text": "Looking for your ACK development device"}, errors=UGS_ERROR_SELECTORS, timeout=150) != WAIT_DONE:
             logger.error("Unable to find the device.")
             log_error_info(device)
             return False
 
+        begin_step("connecting_to_device")
         logger.info("Connecting to the device ...")
-        if not device(resourceId="mosaic.base_text", text="Connecting to your ACK development device").wait_gone(timeout=150):
+        if wait_phase(device, progress={"resourceId": "mosaic.base_text", "text": "Connecting to your ACK development device"}, errors=UGS_ERROR_SELECTORS, timeout=150) != WAIT_DONE:
             logger.error("Unable to connect to the device.")
             log_error_info(device)
             return False
 
+        begin_step("select_wifi")
         logger.info("Selecting WiFi ...")
-        time.sleep(2)
+        settle(device, "wifi_list", 2, until=[{"resourceId": "Mosaic.radio_list_item-primary", "text": saved_wifi_ssid}])
+        # The list fills in and reorders while scans arrive, so the row is looked up at click time
         device(resourceId="Mosaic.radio_list_item-primary", text=saved_wifi_ssid).click()
-        device.xpath('//*[@text="Next"]').click()
+        invalidate_snapshot(device)
+        ui_tap(device, '//*[@text="Next"]')
 
+        begin_step("registering")
         logger.info("Waiting for the device to register ...")
-        if not device(resourceId="mosaic.base_text", text="Connecting your ACK development device to ").wait_gone(timeout=150):
+        if wait_phase(device, progress={"resourceId": "mosaic.base_text", "text": "Connecting your ACK development device to "}, errors=UGS_ERROR_SELECTORS, timeout=150) != WAIT_DONE:
             logger.error("Unable to connect the device to WiFi.")
             log_error_info(device)
             return False
 
+        begin_step("completion")
         logger.info("Waiting for completion ...")
-        if not device.xpath('//*[@resource-id="NewDeviceFoundPage"]').wait(60):
+        if wait_phase(device, success=[{"resourceId": "NewDeviceFoundPage"}], errors=UGS_ERROR_SELECTORS, timeout=60) != WAIT_DONE:
             logger.error("Connecting to the device failed!")
             log_error_info(device)
             return False
@@ -167,64 +1413,49 @@ def execute_test_ugs(device, saved_wifi_ssid):
         logger.error(traceback.format_exc())
         return False
 
+@timed_flow("BCS")
 def execute_test_bcs(device, saved_wifi_ssid):
     try:
         logger.info("Starting BCS test...")
-        restart_alexa_app(device)
-        handle_lts_card(device)
-        
-        logger.info("Clicking button '+' ...")
-        if not ui_click(device, "com.amazon.dee.app:id/home_header_quick_add", "1-primary", 10):
-            logger.error("Unable to see the add device menu.")
-            return False
-
-        logger.info("Clicking button 'Add Device' ...")
-        if not ui_click(device, "1-primary", "AddDevicesLandingPage", 10):
-            logger.error("Unable to see the AddDevicesLandingPage.")
-            return False
-
-        logger.info("Scrolling down to find 'Development Device' ...")
-        device(scrollable=True).scroll.to(text="Development Device")
-        logger.info("Clicking 'Development Device' ...")
-        if not ui_click(device, "DeviceTypeRow_Development Device-primary", "DiscoveryBrandSelectionPage", 10):
-            logger.error("Unable to see the DiscoveryBrandSelectionPage.")
-            return False
-
-        logger.info("Clicking 'ACK' ...")
-        if not ui_click(device, "DeviceBrandRow_ACK=0-primary", "mosaic.pages.InstructionalPage-title", 10):
-            logger.error("Unable to see the InstructionalPage.")
-            return False
-
-        logger.info("Clicking 'Yes' to confirm device is powered on ...")
-        if not ui_click_id_with_text(device, "mosaic.base_text", "Yes", "mosaic.pages.InstructionalPage-title", 10):
+        if not navigate_to(device, "ack_code_choice"):
             logger.error("Unable to see the InstructionalPage (UGS/BCS).")
             return False
 
+        begin_step("scan_code")
         logger.info("Clicking 'Scan Code' to start BCS ...")
-        device(resourceId="mosaic.pages.InstructionalPage-footer-primary-btn").click()
-        device(resourceId="mosaic.text", text="Scan the 2D barcode for your development device").wait(10)
-        time.sleep(2)
+        scan_started = [{"resourceId": "mosaic.text", "text": "Scan the 2D barcode for your development device"},
+                        {"resourceId": "mosaic.base_text", "text": "Looking for your ACK development device"}]
+        if not retry_step(device, "scan_code",
+                          lambda: tap_until(device, {"resourceId": "mosaic.pages.InstructionalPage-footer-primary-btn"}, scan_started, errors=UGS_ERROR_SELECTORS),
+                          RetryPolicy(done=scan_started, rollback="ack_code_choice")):
+            logger.error("Unable to start scanning the code.")
+            return False
+        settle(device, "scan_code", 2, until=[{"resourceId": "mosaic.base_text", "text": "Looking for your ACK development device"}] + UGS_ERROR_SELECTORS)
 
+        begin_step("looking_for_device")
         logger.info("Looking for the device ...")
-        if not device(resourceId="mosaic.base_text", text="Looking for your ACK development device").wait_gone(timeout=150):
+        if wait_phase(device, progress={"resourceId": "mosaic.base_text", "text": "Looking for your ACK development device"}, errors=UGS_ERROR_SELECTORS, timeout=150) != WAIT_DONE:
             logger.error("Unable to find the device.")
             log_error_info(device)
             return False
 
+        begin_step("connecting_to_device")
         logger.info("Connecting to the device ...")
-        if not device(resourceId="mosaic.base_text", text="Connecting to your ACK development device").wait_gone(timeout=150):
+        if wait_phase(device, progress={"resourceId": "mosaic.base_text", "text": "Connecting to your ACK development device"}, errors=UGS_ERROR_SELECTORS, timeout=150) != WAIT_DONE:
             logger.error("Unable to connect to the device.")
             log_error_info(device)
             return False
 
+        begin_step("registering")
         logger.info("Waiting for the device to register ...")
-        if not device(resourceId="mosaic.base_text", text="Connecting your ACK development device to ").wait_gone(timeout=150):
+        if wait_phase(device, progress={"resourceId": "mosaic.base_text", "text": "Connecting your ACK development device to "}, errors=UGS_ERROR_SELECTORS, timeout=150) != WAIT_DONE:
             logger.error("Unable to connect the device to WiFi.")
             log_error_info(device)
             return False
 
+        begin_step("completion")
         logger.info("Waiting for completion ...")
-        if not device.xpath('//*[@resource-id="NewDeviceFoundPage"]').wait(60):
+        if wait_phase(device, success=[{"resourceId": "NewDeviceFoundPage"}], errors=UGS_ERROR_SELECTORS, timeout=60) != WAIT_DONE:
             logger.error("Connecting to the device failed!")
             log_error_info(device)
             return False
@@ -240,17 +1471,18 @@ def execute_test_bcs(device, saved_wifi_ssid):
 def execute_device_discovering(device):
     try:
         logger.info("Starting discovering...")        
-        restart_alexa_app(device)
+        open_alexa_app(device)
         logger.info("Switching to device page...")
-        device.xpath('//*[@resource-id="com.amazon.dee.app:id/tab_channels_device_icon"]').click()
-        time.sleep(3)
+        ui_tap(device, '//*[@resource-id="com.amazon.dee.app:id/tab_channels_device_icon"]')
+        settle(device, "devices_tab", 3, until=[{"resourceId": "com.amazon.dee.app:id/fab"}, {"resourceId": "FullScreenTakeover::PrimaryButton"}])
         handle_lts_card(device)
 
-        device(resourceId="com.amazon.dee.app:id/fab").wait(10)
-        device(resourceId="com.amazon.dee.app:id/fab").click()
+        ui_wait(device, {"resourceId": "com.amazon.dee.app:id/fab"}, 10)
+        ui_tap(device, {"resourceId": "com.amazon.dee.app:id/fab"})
         device.clear_text()
         device.send_keys("discover device")
         device.send_action()
+        invalidate_snapshot(device)
 
         return True
     except Exception:
@@ -258,140 +1490,161 @@ def execute_device_discovering(device):
         logger.error(traceback.format_exc())
         return False
 
-def execute_test_zts(device, device_name):
+def wait_device_in_list(device, device_name, timeout_sec):
+    deadline = time.time() + timeout_sec
+    while time.time() < deadline:
+        device.swipe_ext("down")
+        invalidate_snapshot(device)
+
+        handle_lts_card(device)
+
+        # Poll for the device while the list refreshes instead of sleeping a fixed 2s per pass
+        if ui_wait(device, {"resourceId": "mosaic.text", "text": device_name}, 2):
+            return True
+    return False
+
+@timed_flow("ZTS")
+def execute_test_zts(device, device_name, detect_mode="ui"):
+    logcat = None
     try:
         logger.info("Starting ZTS test...")
+        begin_step("start_discovery")
+        if detect_mode == "logcat":
+            # Start streaming before the discovery command so the device-added event cannot be missed
+            # Only a pattern naming the device guarantees the name is on every matching line
+            prefilter = device_name if "{device_name}" in zts_logcat_pattern else None
+            logcat = LogcatWatcher(device.serial, zts_logcat_regex(device_name), prefilter=prefilter)
+            logcat.start()
         if execute_device_discovering(device) is True:
-            time.sleep(2)
+            detect_start = time.time()
+            settle(device, "discovery_command", 2)
         else:
             logger.error(f"failed to start device discovering.")
             return False
-        
-        restart_alexa_app(device)
-        logger.info("Switching to device page...")
-        device.xpath('//*[@resource-id="com.amazon.dee.app:id/tab_channels_device_icon"]').click()
-        time.sleep(3)
-        handle_lts_card(device)
 
-        time_passed = 0
-        while time_passed < 60:
-            device.swipe_ext("down")
-            time.sleep(2)
-            time_passed = time_passed + 2
+        detected_in_logcat = False
+        if logcat is not None:
+            begin_step("detect_device")
+            if logcat.wait(60):
+                detected_in_logcat = True
+                time_to_detect = max(0.0, logcat.matched_at - detect_start)
+                logger.info(f"Device-added event for {device_name} seen in logcat after {time_to_detect:.1f}s: {logcat.matched_line}")
+                record_step("time_to_detect_logcat", detect_start, time_to_detect, "ok")
+            else:
+                logger.warning(f"No device-added event for {device_name} in logcat during 60s, checking the UI.")
 
-            handle_lts_card(device)
+        begin_step("restart_app")
+        open_alexa_app(device)
+        begin_step("open_devices_tab")
+        logger.info("Switching to device page...")
+        ui_tap(device, '//*[@resource-id="com.amazon.dee.app:id/tab_channels_device_icon"]')
+        settle(device, "devices_tab", 3)
+        handle_lts_card(device)
 
-            if device.exists(resourceId="mosaic.text", text=device_name):
+        if logcat is not None:
+            # The UI only confirms what logcat already reported
+            begin_step("confirm_device")
+            if wait_device_in_list(device, device_name, 15):
+                if not detected_in_logcat:
+                    logger.warning(f"Target device {device_name} found in the UI but not in logcat, check --zts_logcat_pattern.")
+                    record_step("time_to_detect_ui", detect_start, time.time() - detect_start, "ok")
                 logger.info(f"Target device {device_name} found!")
                 return True
+            logger.error(f"Target device {device_name} not confirmed in the device list.")
+            _worker.failure_class = FAILURE_DUT
+            return False
+
+        begin_step("detect_device")
+        if wait_device_in_list(device, device_name, 60):
+            time_to_detect = time.time() - detect_start
+            logger.info(f"Target device {device_name} found after {time_to_detect:.1f}s!")
+            record_step("time_to_detect_ui", detect_start, time_to_detect, "ok")
+            return True
 
         logger.error(f"Target device {device_name} not found during 60s.")
+        _worker.failure_class = FAILURE_DUT
         return False
     except Exception:
         logger.error("Exception happened")
         logger.error(traceback.format_exc())
         return False
+    finally:
+        if logcat is not None:
+            logcat.stop()
 
+@timed_flow("Matter")
 def execute_test_matter(device, saved_wifi_ssid, pairing_code_11d):
     try:
         logger.info("Starting Matter setup test...")
-        restart_alexa_app(device)
-        logger.info("Clicking button '+' ...")
-        if not ui_click(device, "com.amazon.dee.app:id/home_header_quick_add", "1-primary", 10):
-            logger.error("Unable to see the add device menu.")
-            return False
-
-        time.sleep(1)
-
-        logger.info("Clicking button 'Add Device' ...")
-        if not ui_click(device, "1-primary", "AddDevicesLandingPage", 10):
-            logger.error("Unable to see the AddDevicesLandingPage.")
-            return False
-
-        logger.info("Scrolling down to find 'Other' ...")
-        # device(scrollable=True).scroll.to(steps=20, text="Other")
-        device(scrollable=True).scroll.toEnd()
-        time.sleep(3)
-        logger.info("Clicking 'Other' ...")
-        if not ui_click(device, "DeviceTypeRow_Other-primary", "mosaic-tiles_grid_0_genericMatter", 10):
-            logger.error("Unable to see the Generic Matter icon.")
-            return False
-        time.sleep(1)
-
-        logger.info("Clicking 'Matter' ...")
-        device(resourceId="mosaic-tiles_grid_0_genericMatter").click()
-        device(resourceId="mosaic.base_text", text="Does your device have a Matter logo?").wait(10)
-        if not ui_click_id_with_text(device, "mosaic.base_text", "YES", "power-on-check-footer-primary-btn", 10):
-            logger.error("Unable to see the InstructionalPage.")
-            return False
-
-        logger.info("Clicking 'Yes' to confirm device is powered on ...")
-        if not ui_click(device, "power-on-check-footer-primary-btn", "locate-qr-code-page-footer-secondary-btn", 10):
-            logger.error("Unable to see the InstructionalPage (Locate QR code).")
-            return False
-
-        logger.info("Clicking 'Try Numeric Code Instead?' to confirm using digital pairing code ...")
-        if not ui_click(device, "locate-qr-code-page-footer-secondary-btn", "locate-numerical-code-page-footer-primary-btn", 10):
-            logger.error("Unable to see the InstructionalPage (Locate the numeric code).")
-            return False
-
-        logger.info("Clicking 'Enter Code' to continue ...")
-        if not ui_click(device, "locate-numerical-code-page-footer-primary-btn", "input-numeric-code-page-BodyText", 10):
+        if not navigate_to(device, "matter_input_code"):
             logger.error("Unable to see the page containing the input box for the numeric code.")
             return False
 
+        begin_step("input_code")
         # input the code
-        device.xpath('//android.widget.ScrollView/android.view.ViewGroup[1]/android.view.ViewGroup[1]').click()
+        ui_tap(device, '//android.widget.ScrollView/android.view.ViewGroup[1]/android.view.ViewGroup[1]')
         device.clear_text()
         logger.info(f"The 11-digits pairing code is: {pairing_code_11d}")
         device.send_keys(f"{pairing_code_11d}")
         device.send_action()
-        time.sleep(1)
+        invalidate_snapshot(device)
+        settle(device, "code_input", 1)
 
+        begin_step("confirm_next")
         logger.info("Clicking 'Next' to continue ...")
-        device(resourceId="input-numeric-code-page-footer-primary-btn").click()
-        device(resourceId="input-numeric-code-page-footer-primary-btn").wait_gone(2)
+        next_button = {"resourceId": "input-numeric-code-page-footer-primary-btn"}
+        if not retry_step(device, "confirm_next",
+                          lambda: tap_until(device, next_button, gone=next_button, errors=MATTER_ERROR_SELECTORS, timeout_sec=2),
+                          RetryPolicy(done=[{"resourceId": "mosaic.base_text", "text": "Looking for your device"}] + MATTER_ERROR_SELECTORS)):
+            logger.error("Unable to leave the page containing the input box for the numeric code.")
+            return False
 
+        begin_step("looking_for_device")
         logger.info("Looking for the device ...")
-        device(resourceId="mosaic.base_text", text="Looking for your device").wait(timeout=10)
-        if not device(resourceId="mosaic.base_text", text="Looking for your device").wait_gone(timeout=30):
+        wait_phase(device, success=[{"resourceId": "mosaic.base_text", "text": "Looking for your device"}], errors=MATTER_ERROR_SELECTORS, timeout=10)
+        if wait_phase(device, progress={"resourceId": "mosaic.base_text", "text": "Looking for your device"}, errors=MATTER_ERROR_SELECTORS, timeout=30) != WAIT_DONE:
             logger.error("Unable to find the device.")
             log_error_info_for_matter(device)
             return False
 
-        if device.exists(resourceId="mosaic.base_text", text="Still looking for your device"):
+        if ui_exists(device, {"resourceId": "mosaic.base_text", "text": "Still looking for your device"}):
+            begin_step("still_looking_for_device")
             logger.info("Still looking for the device ...")
-            if not device(resourceId="mosaic.base_text", text="Still looking for your device").wait_gone(timeout=30):
+            if wait_phase(device, progress={"resourceId": "mosaic.base_text", "text": "Still looking for your device"}, errors=MATTER_ERROR_SELECTORS, timeout=30) != WAIT_DONE:
                 logger.error("Unable to find the device after long retry.")
                 log_error_info_for_matter(device)
                 return False
             else:
                 logger.info("Looking for the device ended...")
-                if device.exists(resourceId="mosaic.base_text", text="Is this device set up for control with another assistant or app?"):
+                if ui_exists(device, {"resourceId": "mosaic.base_text", "text": "Is this device set up for control with another assistant or app?"}):
                     logger.error("Unable to find the device after final retry.")
                     log_error_info_for_matter(device)
                     return False
 
+        begin_step("connecting_to_device")
         logger.info("Connecting to the device...")
-        if not device(resourceId="mosaic.base_text", text="Connecting to your device").wait_gone(timeout=30):
+        if wait_phase(device, progress={"resourceId": "mosaic.base_text", "text": "Connecting to your device"}, errors=MATTER_ERROR_SELECTORS, timeout=30) != WAIT_DONE:
             logger.error("Unable to connect to the device.")
             log_error_info_for_matter(device)
             return False
 
+        begin_step("connecting_to_network")
         logger.info("Connecting the device to the network...")
-        if not device(resourceId="mosaic.base_text", text="Connecting your device to the network").wait_gone(timeout=30):
+        if wait_phase(device, progress={"resourceId": "mosaic.base_text", "text": "Connecting your device to the network"}, errors=MATTER_ERROR_SELECTORS, timeout=30) != WAIT_DONE:
             logger.error("Unable to connect the device to the network.")
             log_error_info_for_matter(device)
             return False
 
+        begin_step("getting_device_ready")
         logger.info("Waiting for the msg `Alexa is getting your device ready` ...")
-        if not device(resourceId="mosaic.base_text", text="Alexa is getting your device ready").wait_gone(timeout=30):
+        if wait_phase(device, progress={"resourceId": "mosaic.base_text", "text": "Alexa is getting your device ready"}, errors=MATTER_ERROR_SELECTORS, timeout=30) != WAIT_DONE:
             logger.error("Unable to see the msg `Alexa is getting your device ready`.")
             log_error_info_for_matter(device)
             return False
 
+        begin_step("completion")
         logger.info("Waiting for completion ...")
-        if not device(resourceId="commissioning-complete-page").wait(60):
+        if wait_phase(device, success=[{"resourceId": "commissioning-complete-page"}], errors=MATTER_ERROR_SELECTORS, timeout=60) != WAIT_DONE:
             logger.error("Connecting to the device failed!")
             log_error_info_for_matter(device)
             return False
@@ -404,39 +1657,150 @@ def execute_test_matter(device, saved_wifi_ssid, pairing_code_11d):
         logger.error(traceback.format_exc())
         return False
 
-def execute_factory_reset(device, device_name):
+# Factory reset
+DEVICE_SETTINGS_BUTTON = '//*[@content-desc="Settings"]/android.widget.ImageView[1]'
+DEVICE_DELETE_BUTTON = '//*[@content-desc="Delete"]/android.widget.ImageView[1]'
+DIALOG_CONFIRM_BUTTON = '//*[@resource-id="android:id/button1"]'
+DEVICES_TAB_ICON = '//*[@resource-id="com.amazon.dee.app:id/tab_channels_device_icon"]'
+DEVICES_LIST_ANCHOR = {"resourceId": "com.amazon.dee.app:id/fab"}
+SCROLLABLE_LIST = '//*[@scrollable="true"]'
+RESET_INTENT_TIMEOUT_SEC = 15
+RESET_VERIFY_TIMEOUT_SEC = 30
+RESET_VERIFY_MAX_SWIPES = 5
+
+# Arguments of "adb shell am start" that open the settings of a device, e.g.
+# -a android.intent.action.VIEW -d <uri with {device_name_url}>
+factory_reset_intent = None
+
+def open_device_page_by_intent(device, device_name):
+    args = shlex.split(factory_reset_intent.format(device_name=device_name,
+                                                   device_name_url=urllib.parse.quote(device_name, safe='')))
+    logger.info(f"Opening the page of the device '{device_name}' with am start {' '.join(args)} ...")
     try:
-        logger.info("Factory resetting the device")
-        restart_alexa_app(device)
-        logger.info("Switching to device page...")
-        device.xpath('//*[@resource-id="com.amazon.dee.app:id/tab_channels_device_icon"]').click()
-        time.sleep(3)
-
-        device.swipe_ext("down")
-        time.sleep(2)
-        device.swipe_ext("down")
-        time.sleep(3)
+        output, exit_code = device.shell(["am", "start", "-W"] + args)
+    except Exception:
+        logger.warning(traceback.format_exc())
+        return False
+    invalidate_snapshot(device)
+    if exit_code != 0 or "Error" in output:
+        logger.warning(f"am start failed: {output.strip()}")
+        return False
+    outcome = wait_for_any(device, [(WAIT_DONE, DEVICE_SETTINGS_BUTTON, True),
+                                    (WAIT_DONE, DEVICE_DELETE_BUTTON, True)], RESET_INTENT_TIMEOUT_SEC)
+    if outcome != WAIT_DONE:
+        logger.warning("The intent did not open the device page.")
+        return False
+    return True
 
-        logger.info(f"Locating the device '{device_name}' ...")
+def open_device_page_by_ui(device, device_name):
+    begin_step("restart_app")
+    open_alexa_app(device)
+    begin_step("open_devices_tab")
+    logger.info("Switching to device page...")
+    ui_tap(device, DEVICES_TAB_ICON)
+    settle(device, "devices_tab", 3)
+
+    begin_step("refresh_device_list")
+    device.swipe_ext("down")
+    invalidate_snapshot(device)
+    settle(device, "device_list_refresh", 2)
+    device.swipe_ext("down")
+    invalidate_snapshot(device)
+    settle(device, "device_list_refresh", 3)
+
+    begin_step("locate_device")
+    logger.info(f"Locating the device '{device_name}' ...")
+    if not ui_exists(device, {"resourceId": "mosaic.text", "text": device_name}):
         device(scrollable=True).scroll.to(text=device_name)
+        invalidate_snapshot(device)
 
-        logger.info(f"Clicking into the GUI page of the device '{device_name}' ...")
-        device(resourceId="mosaic.text", text=device_name).click()
+    begin_step("open_device_page")
+    logger.info(f"Clicking into the GUI page of the device '{device_name}' ...")
+    ui_tap(device, {"resourceId": "mosaic.text", "text": device_name})
 
-        logger.info(f"Loading the GUI page of the device '{device_name}' ...")
-        device.xpath('//*[@content-desc="Settings"]/android.widget.ImageView[1]').wait(60)
+    begin_step("load_device_page")
+    logger.info(f"Loading the GUI page of the device '{device_name}' ...")
+    return ui_wait(device, DEVICE_SETTINGS_BUTTON, 60)
 
-        logger.info(f"Clicking the setting button of the device '{device_name}' ...")
-        device.xpath('//*[@content-desc="Settings"]/android.widget.ImageView[1]').click()
-        device.xpath('//*[@content-desc="Delete"]/android.widget.ImageView[1]').wait(10)
+def show_device_list(device, timeout_sec):
+    if ui_exists(device, DEVICES_LIST_ANCHOR):
+        return True
+    if not ui_exists(device, DEVICES_TAB_ICON):
+        return False
+    ui_tap(device, DEVICES_TAB_ICON)
+    return ui_wait(device, DEVICES_LIST_ANCHOR, timeout_sec)
+
+def wait_device_removed(device, device_name, timeout_sec):
+    # A missing row only counts while the device list is on screen.
+    # The list can still show a deleted device until it has been refreshed.
+    selector = {"resourceId": "mosaic.text", "text": device_name}
+    deadline = time.time() + timeout_sec
+    while time.time() < deadline:
+        if not show_device_list(device, 10):
+            logger.error("The device list is not on screen, cannot check the deletion.")
+            return False
+        device.swipe_ext("down")
+        invalidate_snapshot(device)
+        if not ui_wait(device, DEVICES_LIST_ANCHOR, 5):
+            continue
+        if ui_wait_gone(device, selector, 2) and not device_listed(device, device_name):
+            return True
+    return False
+
+def device_listed(device, device_name, max_swipes=RESET_VERIFY_MAX_SWIPES):
+    # Pages through the first screens of the list only: scroll.to() walks the whole list
+    # whenever the row is missing, which is the expected case after a deletion
+    selector = {"resourceId": "mosaic.text", "text": device_name}
+    found = ui_exists(device, selector)
+    swipes = 0
+    while not found and swipes < max_swipes and ui_exists(device, SCROLLABLE_LIST):
+        moved = device(scrollable=True).scroll.forward()
+        invalidate_snapshot(device)
+        swipes += 1
+        found = ui_exists(device, selector)
+        if not moved:
+            break
+    if found and swipes:
+        # Back to the top, so that the next pull refreshes the list
+        device(scrollable=True).scroll.toBeginning()
+        invalidate_snapshot(device)
+    return found
+
+@timed_flow("FactoryReset")
+def execute_factory_reset(device, device_name):
+    try:
+        logger.info("Factory resetting the device")
+        opened = False
+        if factory_reset_intent:
+            begin_step("open_device_page_intent")
+            opened = open_device_page_by_intent(device, device_name)
+            if not opened:
+                logger.warning("Falling back to navigating to the device page.")
+        if not opened and not open_device_page_by_ui(device, device_name):
+            logger.error(f"Failed to open the GUI page of the device '{device_name}'")
+            return False
+
+        # The intent may already land on the settings page
+        if not ui_exists(device, DEVICE_DELETE_BUTTON):
+            begin_step("open_settings")
+            logger.info(f"Clicking the setting button of the device '{device_name}' ...")
+            ui_tap(device, DEVICE_SETTINGS_BUTTON)
+            ui_wait(device, DEVICE_DELETE_BUTTON, 10)
 
+        begin_step("delete_device")
         logger.info(f"Clicking the delete button of the device '{device_name}' ...")
-        device.xpath('//*[@content-desc="Delete"]/android.widget.ImageView[1]').click()
-        device.xpath('//*[@resource-id="android:id/button1"]').wait(10)
+        ui_tap(device, DEVICE_DELETE_BUTTON)
+        ui_wait(device, DIALOG_CONFIRM_BUTTON, 10)
 
+        begin_step("confirm_delete")
         logger.info(f"Confirming the deletion of the device '{device_name}' ...")
-        device.xpath('//*[@resource-id="android:id/button1"]').click()
-        time.sleep(2)
+        ui_tap(device, DIALOG_CONFIRM_BUTTON)
+        settle(device, "confirm_delete", 2, gone=DIALOG_CONFIRM_BUTTON)
+
+        begin_step("verify_removed")
+        if not wait_device_removed(device, device_name, RESET_VERIFY_TIMEOUT_SEC):
+            logger.error(f"Device {device_name} is still listed after the deletion.")
+            return False
         logger.info(f"Device {device_name} is removed from Alexa!")
         return True
     except Exception:
@@ -444,52 +1808,623 @@ def execute_factory_reset(device, device_name):
         logger.error(traceback.format_exc())
         return False
 
+# Multi-phone runner
+class Phone:
+    def __init__(self, serial, device_name, wifi_ssid, pairing_code_11d):
+        self.serial = serial
+        self.device_name = device_name
+        self.wifi_ssid = wifi_ssid
+        self.pairing_code_11d = pairing_code_11d
+
+def load_phones(args):
+    phones = []
+    if args.serial_file:
+        # One phone per line: serial[,device_name[,wifi_ssid[,pairing_code_11d]]]
+        with open(args.serial_file, newline='') as f:
+            for row in csv.reader(f):
+                row = [col.strip() for col in row]
+                if not row or not row[0] or row[0].startswith('#'):
+                    continue
+                device_name = row[1] if len(row) > 1 and row[1] else args.device_name
+                wifi_ssid = row[2] if len(row) > 2 and row[2] else args.wifi_ssid
+                pairing_code_11d = int(row[3]) if len(row) > 3 and row[3] else args.pairing_code_11d
+                phones.append(Phone(row[0], device_name, wifi_ssid, pairing_code_11d))
+    else:
+        for serial in args.serial.split(','):
+            serial = serial.strip()
+            if serial:
+                phones.append(Phone(serial, args.device_name, args.wifi_ssid, args.pairing_code_11d))
+    return phones
+
+class PoolStats:
+    def __init__(self, mode, test_count):
+        self.mode = mode
+        self.test_count = test_count
+        self.claimed = 0
+        self.success_cnt = 0
+        self.failure_cnt = 0
+        self.failure_classes = collections.Counter()
+        self.retries = 0
+        self.busy_time = 0.0
+        self.per_serial = {}
+        self.saved_time = 0.0
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+
+    def state(self):
+        with self.lock:
+            return {"claimed": self.claimed, "success_cnt": self.success_cnt, "failure_cnt": self.failure_cnt,
+                    "failure_classes": dict(self.failure_classes), "retries": self.retries,
+                    "busy_time": self.busy_time, "saved_time": self.saved_time}
+
+    def restore(self, state):
+        with self.lock:
+            self.claimed = state["claimed"]
+            self.success_cnt = state["success_cnt"]
+            self.failure_cnt = state["failure_cnt"]
+            self.failure_classes = collections.Counter(state["failure_classes"])
+            self.retries = state["retries"]
+            self.busy_time = state["busy_time"]
+            self.saved_time = state["saved_time"]
+
+    def mean_duration(self):
+        with self.lock:
+            executed = self.success_cnt + self.failure_cnt
+            return self.busy_time / executed if executed else 0.0
+
+    def record(self, serial, test_result, failure_class=None, retries=0, duration=0.0):
+        with self.lock:
+            serial_stats = self.per_serial.setdefault(serial, [0, 0])
+            self.retries += retries
+            self.busy_time += duration
+            if test_result:
+                self.success_cnt += 1
+                serial_stats[0] += 1
+            else:
+                self.failure_cnt += 1
+                self.failure_classes[failure_class] += 1
+                serial_stats[1] += 1
+
+    def record_saved_time(self, seconds):
+        with self.lock:
+            self.saved_time += seconds
+
+    def record_busy_time(self, seconds):
+        with self.lock:
+            self.busy_time += seconds
+
+    def log_summary(self):
+        with self.lock:
+            executed = self.success_cnt + self.failure_cnt
+            elapsed_hours = (time.time() - self.start_time) / 3600
+            rate = executed / elapsed_hours if elapsed_hours > 0 else 0.0
+            logger.info(f"=======================================================")
+            logger.info(f" Execute Summary:")
+            logger.info(f" Total executed {self.mode} times: {executed}" + (f" / {self.test_count}" if self.test_count else ""))
+            logger.info(f" Total successful {self.mode}: {self.success_cnt}")
+            logger.info(f" Total failed {self.mode}: {self.failure_cnt}")
+            if self.failure_cnt:
+                logger.info(f"   DUT/provisioning failures: {self.failure_classes[FAILURE_DUT]}, automation failures: {self.failure_classes[FAILURE_AUTOMATION]}")
+            if self.retries:
+                logger.info(f" UI steps retried: {self.retries}")
+            if report_saved_time and executed:
+                logger.info(f" Average wall time recovered versus fixed sleeps: {self.saved_time / executed:.1f}s/iteration")
+            if len(self.per_serial) > 1:
+                logger.info(f" Throughput: {rate:.1f} iterations/hour")
+                for serial, (success, failure) in sorted(self.per_serial.items()):
+                    logger.info(f"   {serial}: {success} successful, {failure} failed")
+            logger.info(f"=======================================================")
+
+# Mode scheduling
+VALID_MODES = ['UGS', 'BCS', 'ZTS', 'Matter']
+MODE_PARAMETERS = ["device_name", "wifi_ssid", "pairing_code_11d"]
+
+class ModeScheduler:
+    # Hands out iterations to the phone workers. Modes are interleaved by smooth weighted round-robin,
+    # in batches of consecutive iterations per phone. Modes are not reordered: every successful iteration
+    # ends with a factory reset on the Devices tab, so each flow starts from the same page whatever ran before.
+    def __init__(self, modes, max_iterations=None, budget_sec=None, batch=1):
+        # modes: mode -> {"weight": ..., plus MODE_PARAMETERS overriding the phone's}
+        self.modes = modes
+        self.weights = {mode: float(params.get("weight", 1)) for mode, params in modes.items()}
+        self.credits = dict.fromkeys(modes, 0.0)
+        self.max_iterations = max_iterations
+        self.deadline = time.time() + budget_sec if budget_sec else None
+        self.batch = max(1, batch)
+        self.batches = {}
+        self.claimed = 0
+        self.stopped = False
+        self.stop_requested = False
+        self.stats = {mode: PoolStats(mode, max_iterations if len(modes) == 1 else None) for mode in modes}
+        self.popups = collections.Counter()
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+
+    def _next_mode(self):
+        for mode, weight in self.weights.items():
+            self.credits[mode] += weight
+        mode = max(self.credits, key=self.credits.get)
+        self.credits[mode] -= sum(self.weights.values())
+        return mode
+
+    def claim(self, serial):
+        with self.lock:
+            if self.stopped or (self.max_iterations is not None and self.claimed >= self.max_iterations):
+                return None
+            mode, left = self.batches.get(serial, (None, 0))
+            if left == 0:
+                mode, left = self._next_mode(), self.batch
+            stats = self.stats[mode]
+            if self.deadline is not None:
+                # Do not start an iteration that is not expected to finish within the budget
+                remaining = self.deadline - time.time()
+                if remaining <= stats.mean_duration():
+                    logger.info(f"Time budget spent ({max(0.0, remaining):.0f}s left), not starting new iterations")
+                    self.stopped = True
+                    return None
+            self.batches[serial] = (mode, left - 1)
+            self.claimed += 1
+            stats.claimed += 1
+            return mode, stats, stats.claimed
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+
+    def request_stop(self, signum, frame):
+        # Signal handler: the first Ctrl+C or SIGTERM lets every phone finish its current iteration,
+        # a second one aborts. No lock here, the interrupted thread may be holding it.
+        if self.stop_requested:
+            raise KeyboardInterrupt
+        self.stop_requested = True
+        self.stopped = True
+        logger.info("Stopping after the running iterations, press Ctrl+C again to abort ...")
+
+    def phone_for(self, phone, mode):
+        params = self.modes[mode]
+        return Phone(phone.serial, params.get("device_name", phone.device_name), params.get("wifi_ssid", phone.wifi_ssid),
+                     params.get("pairing_code_11d", phone.pairing_code_11d))
+
+    def record_popups(self, counts):
+        with self.lock:
+            self.popups.update(counts)
+
+    def log_summary(self):
+        if len(self.modes) == 1:
+            return
+        elapsed_hours = (time.time() - self.start_time) / 3600
+        executed = sum(stats.success_cnt + stats.failure_cnt for stats in self.stats.values())
+        logger.info(f"=======================================================")
+        logger.info(f" Scenario Summary: {executed} iterations in {elapsed_hours:.2f}h of bench time"
+                    f" ({executed / elapsed_hours if elapsed_hours > 0 else 0.0:.1f} iterations/hour)")
+        for mode, stats in self.stats.items():
+            mode_executed = stats.success_cnt + stats.failure_cnt
+            logger.info(f"   {mode}: {mode_executed} executed, {stats.success_cnt} successful, {stats.failure_cnt} failed"
+                        f" ({stats.failure_classes[FAILURE_DUT]} DUT, {stats.failure_classes[FAILURE_AUTOMATION]} automation),"
+                        f" {stats.mean_duration():.1f}s/iteration")
+        logger.info(f"=======================================================")
+
+def load_scenario(path):
+    # {"budget_minutes": 480, "batch": 2, "modes": {"UGS": {"weight": 3, "wifi_ssid": "..."}, "ZTS": {"weight": 1}}}
+    with open(path) as f:
+        scenario = json.load(f)
+    if not isinstance(scenario, dict):
+        raise ValueError(f"{path} is not a JSON object")
+    modes = scenario.get("modes")
+    if not modes or not isinstance(modes, dict):
+        raise ValueError(f"{path} has no modes")
+    for mode, params in modes.items():
+        if mode not in VALID_MODES:
+            raise ValueError(f"Unknown mode {mode} in {path}")
+        if not isinstance(params, dict):
+            raise ValueError(f"The parameters of {mode} in {path} must be an object")
+        if not is_positive_number(params.get("weight", 1)):
+            raise ValueError(f"The weight of {mode} in {path} must be a positive number")
+        unknown = set(params) - set(MODE_PARAMETERS) - {"weight"}
+        if unknown:
+            raise ValueError(f"Unknown parameters of {mode} in {path}: {', '.join(sorted(unknown))}")
+    budget_minutes = scenario.get("budget_minutes")
+    if budget_minutes is not None and not is_positive_number(budget_minutes):
+        raise ValueError(f"budget_minutes in {path} must be a positive number")
+    batch = scenario.get("batch", 1)
+    if not is_positive_number(batch) or not isinstance(batch, int):
+        raise ValueError(f"batch in {path} must be a positive integer")
+    return modes, budget_minutes * 60 if budget_minutes else None, batch
+
+def is_positive_number(value):
+    # JSON booleans are ints in Python
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and value > 0
+
+# Soak runs
+SOAK_WINDOW_SIZE = 200
+SOAK_REPORT_INTERVAL_SEC = 600
+SOAK_CHECKPOINT_INTERVAL_SEC = 60
+SOAK_CHECKPOINT_FILE = "soak_checkpoint.json"
+SOAK_RECYCLE_EVERY = 100
+
+soak_monitor = None
+session_recycle_every = 0
+
+def process_rss_mb():
+    # Resident memory of this process, only available on Linux
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return None
+
+class SoakMonitor:
+    # Rolling statistics of an endless run in fixed-size structures: the last N iterations,
+    # and one bucket per minute of the last hour. Counts are checkpointed to resume after a restart.
+    def __init__(self, scheduler, checkpoint_path, window_size=SOAK_WINDOW_SIZE, report_interval_sec=SOAK_REPORT_INTERVAL_SEC):
+        self.scheduler = scheduler
+        self.checkpoint_path = checkpoint_path
+        self.report_interval_sec = report_interval_sec
+        self.window = collections.deque(maxlen=window_size)
+        self.minutes = [[None, 0, 0, 0.0] for _ in range(60)]
+        self.resumed_elapsed = 0.0
+        self.start_time = time.time()
+        self.last_report = self.last_checkpoint = time.time()
+        self.lock = threading.Lock()
+
+    def record(self, mode, test_result, duration, failure_class):
+        now = time.time()
+        with self.lock:
+            self.window.append((mode, test_result, round(duration, 3), failure_class))
+            minute = int(now // 60)
+            bucket = self.minutes[minute % 60]
+            if bucket[0] != minute:
+                bucket[:] = [minute, 0, 0, 0.0]
+            bucket[1 if test_result else 2] += 1
+            bucket[3] += duration
+            report = now - self.last_report >= self.report_interval_sec
+            checkpoint = now - self.last_checkpoint >= SOAK_CHECKPOINT_INTERVAL_SEC
+            if report:
+                self.last_report = now
+            if checkpoint:
+                self.last_checkpoint = now
+        if report:
+            self.log_report()
+        if checkpoint:
+            self.write_checkpoint()
+
+    def elapsed(self):
+        return self.resumed_elapsed + time.time() - self.start_time
+
+    def log_report(self):
+        now_minute = int(time.time() // 60)
+        with self.lock:
+            window = list(self.window)
+            hour = [bucket for bucket in self.minutes if bucket[0] is not None and bucket[0] > now_minute - 60]
+        totals = {mode: stats.state() for mode, stats in self.scheduler.stats.items()}
+        executed = sum(state["success_cnt"] + state["failure_cnt"] for state in totals.values())
+        logger.info(f"=======================================================")
+        logger.info(f" Soak report after {self.elapsed() / 3600:.2f}h: {executed} iterations")
+        for mode, state in totals.items():
+            logger.info(f"   {mode}: {state['success_cnt']} successful, {state['failure_cnt']} failed"
+                        f" ({state['failure_classes'].get(FAILURE_DUT, 0)} DUT, {state['failure_classes'].get(FAILURE_AUTOMATION, 0)} automation)")
+        if window:
+            passed = sum(1 for _, ok, _, _ in window if ok)
+            durations = [duration for _, _, duration, _ in window]
+            logger.info(f" Last {len(window)} iterations: {passed / len(window):.1%} passed,"
+                        f" p50={percentile(durations, 50):.1f}s p90={percentile(durations, 90):.1f}s")
+        hour_passed = sum(bucket[1] for bucket in hour)
+        hour_executed = hour_passed + sum(bucket[2] for bucket in hour)
+        if hour_executed:
+            logger.info(f" Last hour: {hour_executed} iterations, {hour_passed / hour_executed:.1%} passed,"
+                        f" mean {sum(bucket[3] for bucket in hour) / hour_executed:.1f}s/iteration")
+        rss_mb = process_rss_mb()
+        if rss_mb is not None:
+            logger.info(f" Resident memory: {rss_mb:.1f} MB")
+        logger.info(f"=======================================================")
+
+    def write_checkpoint(self):
+        with self.lock:
+            state = {
+                "elapsed_sec": self.elapsed(),
+                "written_at": time.time(),
+                "modes": {mode: stats.state() for mode, stats in self.scheduler.stats.items()},
+                "window": list(self.window),
+                "minutes": [bucket for bucket in self.minutes if bucket[0] is not None],
+            }
+        # Written to a temporary file first, so a crash never leaves a truncated checkpoint behind
+        tmp_path = self.checkpoint_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(state, f)
+            os.replace(tmp_path, self.checkpoint_path)
+        except OSError:
+            logger.error(f"Could not write the checkpoint {self.checkpoint_path}")
+            logger.error(traceback.format_exc())
+
+    def resume(self):
+        if not os.path.exists(self.checkpoint_path):
+            return False
+        with open(self.checkpoint_path) as f:
+            state = json.load(f)
+        for mode, mode_state in state["modes"].items():
+            if mode in self.scheduler.stats:
+                self.scheduler.stats[mode].restore(mode_state)
+        with self.lock:
+            self.window.extend(tuple(entry) for entry in state["window"])
+            for bucket in state["minutes"]:
+                self.minutes[bucket[0] % 60] = list(bucket)
+            self.resumed_elapsed = state["elapsed_sec"]
+        with self.scheduler.lock:
+            self.scheduler.claimed = sum(stats.claimed for stats in self.scheduler.stats.values())
+            self.scheduler.start_time -= self.resumed_elapsed
+            if self.scheduler.deadline is not None:
+                self.scheduler.deadline -= self.resumed_elapsed
+        logger.info(f"Resumed from {self.checkpoint_path}: {self.scheduler.claimed} iterations in {self.resumed_elapsed / 3600:.2f}h")
+        return True
+
+def run_test(device, mode, phone):
+    if mode == 'UGS':
+        return execute_test_ugs(device, phone.wifi_ssid)
+    elif mode == 'BCS':
+        return execute_test_bcs(device, phone.wifi_ssid)
+    elif mode == 'ZTS':
+        return execute_test_zts(device, phone.device_name, zts_detect_mode)
+    elif mode == 'Matter':
+        return execute_test_matter(device, phone.wifi_ssid, phone.pairing_code_11d)
+    return False
+
+def run_worker(phone, scheduler):
+    _worker.serial = phone.serial
+    _worker.popup_watcher = None
+    session = DeviceSession(phone.serial)
+    session_iterations = 0
+    try:
+        while True:
+            work = scheduler.claim(phone.serial)
+            if work is None:
+                break
+            mode, stats, i = work
+            mode_phone = scheduler.phone_for(phone, mode)
+            _worker.dut = mode_phone.device_name
+            run_iteration(session, mode_phone, mode, stats, i)
+            session_iterations += 1
+            if session_recycle_every and session_iterations >= session_recycle_every:
+                # Stop polling the old handle, the next get() starts a watcher on the new one
+                if _worker.popup_watcher is not None:
+                    _worker.popup_watcher.stop()
+                    _worker.popup_watcher.device = None
+                session.recycle()
+                session_iterations = 0
+    finally:
+        if _worker.popup_watcher is not None:
+            _worker.popup_watcher.stop()
+            scheduler.record_popups(_worker.popup_watcher.counts)
+
+def ensure_popup_watcher(device):
+    # The watcher follows the session, so a reconnect gets a fresh watcher with the counts carried over
+    watcher = _worker.popup_watcher
+    if watcher is not None and watcher.device is device:
+        return
+    counts = collections.Counter()
+    if watcher is not None:
+        watcher.stop()
+        counts = watcher.counts
+    _worker.popup_watcher = PopupWatcher(device, _worker.serial)
+    _worker.popup_watcher.counts = counts
+    _worker.popup_watcher.start()
+
+def run_iteration(session, phone, mode, stats, i):
+    _worker.iteration = i
+    _worker.saved_time = {}
+    _worker.last_step = None
+    _worker.error_text = None
+    _worker.failure_class = None
+    _worker.retries = 0
+    logger.info(f"=================== {mode} test {i}" + (f"/{stats.test_count}" if stats.test_count else "") + " ===================")
+    started_at = time.time()
+    try:
+        device = session.get()
+        if popup_watcher_enabled:
+            ensure_popup_watcher(device)
+        test_result = run_test(device, mode, phone)
+    except Exception:
+        logger.error("Exception happened")
+        logger.error(traceback.format_exc())
+        device = None
+        test_result = False
+    duration = time.time() - started_at
+    failure_class = None
+    if not test_result:
+        failure_class = _worker.failure_class or FAILURE_AUTOMATION
+        logger.info(f"Failure classified as: {failure_class}")
+
+    if results_store is not None:
+        results_store.record_iteration(started_at, mode, phone.serial, phone.device_name, i,
+                                       "ok" if test_result else "fail",
+                                       None if test_result else _worker.last_step,
+                                       None if test_result else _worker.error_text, duration, failure_class)
+
+    if not test_result and device is not None and artifact_pipeline is not None:
+        artifact_pipeline.capture(device, phone.serial, mode, i, getattr(_worker, "last_step", None))
+
+    stats.record(phone.serial, test_result, failure_class, _worker.retries, duration)
+    count_metric("ffs_iterations_total", mode=mode, outcome="ok" if test_result else "fail")
+    if failure_class is not None:
+        count_metric("ffs_failures_total", mode=mode, failure_class=failure_class)
+    observe_metric("ffs_iteration_duration_seconds", duration, METRICS_ITERATION_BUCKETS, mode=mode)
+    if test_result:
+        reset_started_at = time.time()
+        try:
+            settle(device, "before_reset", 3)
+            execute_factory_reset(device, phone.device_name)
+            settle(device, "after_reset", 3)
+        except Exception:
+            logger.error("Exception happened")
+            logger.error(traceback.format_exc())
+        # The budget check needs the full cost of an iteration, reset included
+        stats.record_busy_time(time.time() - reset_started_at)
+
+    if report_saved_time:
+        saved_total = sum(_worker.saved_time.values())
+        details = ", ".join(f"{name}={seconds:.1f}s" for name, seconds in _worker.saved_time.items())
+        logger.info(f"Wall time recovered versus fixed sleeps: {saved_total:.1f}s ({details})")
+        stats.record_saved_time(saved_total)
+
+    if _worker.popup_watcher is not None and _worker.popup_watcher.counts:
+        counts = ", ".join(f"{name}={count}" for name, count in _worker.popup_watcher.counts.items())
+        logger.info(f"Popups dismissed so far: {counts}")
+
+    # A soak logs periodic roll-ups instead of a summary per iteration
+    if soak_monitor is not None:
+        soak_monitor.record(mode, test_result, duration, failure_class)
+    else:
+        stats.log_summary()
+
 def main():
-    parser = argparse.ArgumentParser(description="Run FFS tests on an Android device.")
+    if len(sys.argv) > 1 and sys.argv[1] == "query":
+        query_main(sys.argv[2:])
+        return
+
+    global step_recorder, warm_start_enabled, report_saved_time, popup_watcher_enabled
+    global zts_detect_mode, zts_logcat_pattern, zts_logcat_tags, artifact_pipeline, results_store, phase_timeouts
+    global factory_reset_intent, step_retry_attempts, metrics, soak_monitor, session_recycle_every
+    parser = argparse.ArgumentParser(description="Run FFS tests on an Android device. Run 'FFSAutomation.py query --help' to query the results of previous runs.")
     parser.add_argument('--mode', type=str, default="UGS", help='Test mode. Valid values are: UGS, BCS, ZTS and Matter. Here: 1)UGS and BCS are for non-Matter ACK devices. 2)ZTS is for both Matter and non-Matter. 3)Matter is only for Matter device')
-    parser.add_argument('--serial', type=str, default=ANDROID_SERIAL, help='The serial number of the Android device.')
+    parser.add_argument('--serial', type=str, default=ANDROID_SERIAL, help='The serial number of the Android device. Separate several serials with commas to run one worker per phone.')
+    parser.add_argument('--serial_file', type=str, default=None, help='A device inventory file with one phone per line: serial[,device_name[,wifi_ssid[,pairing_code_11d]]]. Overrides --serial.')
     parser.add_argument('--wifi_ssid', type=str, default=SAVED_WIFI_SSID, help='The SSID of the WiFi network to connect to.')
     parser.add_argument('--device_name', type=str, default=DEFAULT_DEVICE_NAME, help='The name of the device on Alexa App.')
-    parser.add_argument('--test_count', type=int, default=MAXIMUM_TEST_COUNT, help='The maximum number of tests to run.')
+    parser.add_argument('--test_count', type=int, default=None, help=f'The maximum number of tests to run, shared across all phones. Defaults to {MAXIMUM_TEST_COUNT}, or no limit with a time budget.')
+    parser.add_argument('--scenario', type=str, default=None, help='A JSON test plan with weighted modes, per-mode parameters (device_name, wifi_ssid, pairing_code_11d) and a time budget: {"budget_minutes": 480, "batch": 2, "modes": {"UGS": {"weight": 3}, "ZTS": {"weight": 1, "device_name": "..."}}}. Overrides --mode.')
+    parser.add_argument('--budget_minutes', type=float, default=None, help='Stop starting new iterations once they would not finish within this many minutes. Overrides the budget of --scenario.')
     parser.add_argument('--pairing_code_11d', type=int, default=None, help='The 11-digits Matter pairing code')
+    parser.add_argument('--warm_start', action='store_true', help='Navigate back to the Alexa home screen instead of restarting the app when it is already running.')
+    parser.add_argument('--report_saved_time', '--report-saved-time', action='store_true', help='Log how much wall time per iteration the condition-driven waits recovered compared to the former fixed sleeps.')
+    parser.add_argument('--no_popup_watcher', action='store_true', help='Do not dismiss known popups from a background watcher; check for them inline in the flows instead.')
+    parser.add_argument('--zts_detect', type=str, default="ui", choices=["ui", "logcat"], help='How ZTS detects the new device: "ui" refreshes the device list, "logcat" waits for the device-added event in a streamed logcat and only confirms it in the UI.')
+    parser.add_argument('--zts_logcat_pattern', type=str, default=ZTS_LOGCAT_PATTERN, help='Regular expression matching the device-added logcat line; {device_name} is replaced by the escaped device name. The default ignores lines reporting a failure, such as "not found".')
+    parser.add_argument('--zts_logcat_tags', type=str, default="", help='Comma-separated logcat tags to stream. Streams all tags when empty.')
+    parser.add_argument('--artifact_dir', type=str, default=ARTIFACT_DIR, help='Where screenshots, UI hierarchies and logcat tails of failed iterations are written.')
+    parser.add_argument('--artifact_budget_mb', type=int, default=ARTIFACT_DISK_BUDGET_MB, help='Disk budget for failure artifacts; the oldest iterations are evicted beyond it.')
+    parser.add_argument('--no_artifacts', action='store_true', help='Do not capture failure artifacts.')
+    parser.add_argument('--log_format', type=str, default="text", choices=["text", "json", "both"], help='Write the human-readable log, a JSON lines log, or both.')
+    parser.add_argument('--log_max_mb', type=int, default=LOG_MAX_MB, help='Rotate log files once they reach this size. Rotated segments are gzip-compressed.')
+    parser.add_argument('--log_rotate_when', type=str, default=None, help='Rotate log files by time instead of size, e.g. "midnight" or "H" (see logging.handlers.TimedRotatingFileHandler).')
+    parser.add_argument('--results_db', type=str, default=RESULTS_DB, help='The SQLite database every iteration is recorded in. Pass an empty string to disable it.')
+    parser.add_argument('--reset_intent', type=str, default=None, help='Arguments of "adb shell am start" that open the page of the device for the factory reset, with {device_name} or {device_name_url} as placeholders, e.g. "-a android.intent.action.VIEW -d <deep link>". Falls back to navigating the UI when it fails.')
+    parser.add_argument('--step_retries', type=int, default=step_retry_attempts, help='Attempts of a UI step before the iteration fails. 1 disables the retries.')
+    parser.add_argument('--static_timeouts', action='store_true', help='Always use the hard-coded phase timeouts instead of deriving them from recorded phase durations.')
+    parser.add_argument('--pin_timeout', type=str, action='append', default=[], help='Pin the timeout of one phase, e.g. --pin_timeout looking_for_device=90. May be repeated.')
+    parser.add_argument('--timeout_margin', type=float, default=ADAPTIVE_TIMEOUT_MARGIN, help='Adaptive phase timeouts are the p99 of recorded durations times this margin.')
+    parser.add_argument('--timeout_floor', type=float, default=ADAPTIVE_TIMEOUT_FLOOR_SEC, help='Adaptive phase timeouts never go below this many seconds.')
+    parser.add_argument('--soak', action='store_true', help='Run until stopped (Ctrl+C or SIGTERM) or until --budget_minutes, with rolling statistics, periodic checkpoints and session recycling.')
+    parser.add_argument('--checkpoint', type=str, default=SOAK_CHECKPOINT_FILE, help='The checkpoint file of --soak. An existing checkpoint is resumed; delete it to start from zero.')
+    parser.add_argument('--soak_window', type=int, default=SOAK_WINDOW_SIZE, help='Number of recent iterations in the rolling statistics of --soak.')
+    parser.add_argument('--soak_report_min', type=float, default=SOAK_REPORT_INTERVAL_SEC / 60, help='Minutes between the roll-up reports of --soak.')
+    parser.add_argument('--recycle_every', type=int, default=None, help=f'Restart the uiautomator session of a phone every N iterations. Defaults to {SOAK_RECYCLE_EVERY} with --soak, otherwise never.')
+    parser.add_argument('--metrics_port', type=int, default=None, help='Serve live counters and histograms in the Prometheus text format on http://<metrics_host>:<port>/metrics.')
+    parser.add_argument('--metrics_host', type=str, default="127.0.0.1", help='The address the metrics endpoint listens on. Use 0.0.0.0 to let another host scrape it.')
+    parser.add_argument('--timing_file', type=str, default=None, help='The JSON lines file receiving per-step timing records. Defaults to timing_{mode}_{time}.jsonl. Rotated like the log files with --soak.')
 
     args = parser.parse_args()
 
-    setup_logging(args.mode)
-
-    if args.mode not in ['UGS', 'BCS', 'ZTS', 'Matter']:
+    phones = load_phones(args)
+    warm_start_enabled = args.warm_start
+    factory_reset_intent = args.reset_intent
+    step_retry_attempts = max(1, args.step_retries)
+    report_saved_time = args.report_saved_time
+    popup_watcher_enabled = not args.no_popup_watcher
+    zts_detect_mode = args.zts_detect
+    zts_logcat_pattern = args.zts_logcat_pattern
+    zts_logcat_tags = [tag.strip() for tag in args.zts_logcat_tags.split(',') if tag.strip()]
+    run_name = "scenario" if args.scenario else args.mode
+    setup_logging(run_name, [phone.serial for phone in phones], args.log_format, args.log_max_mb, args.log_rotate_when)
+
+    if args.scenario:
+        try:
+            modes, budget_sec, batch = load_scenario(args.scenario)
+        except (OSError, ValueError) as e:
+            logger.error(f"Invalid scenario: {e}")
+            return
+    elif args.mode not in VALID_MODES:
         logger.error("Please input valid test mode. Valid values are: UGS, BCS, ZTS and Matter.")
         return
+    else:
+        modes, budget_sec, batch = {args.mode: {}}, None, 1
+    if args.budget_minutes:
+        budget_sec = args.budget_minutes * 60
+    test_count = args.test_count
+    if test_count is None and not budget_sec and not args.soak:
+        test_count = MAXIMUM_TEST_COUNT
+    session_recycle_every = args.recycle_every if args.recycle_every is not None else (SOAK_RECYCLE_EVERY if args.soak else 0)
+
+    if not phones:
+        logger.error("Please input at least one Android serial.")
+        return
 
-    success_cnt = 0
-    failure_cnt = 0
-    for i in range(args.test_count):
-        logger.info(f"=================== {args.mode} test {i+1}/{args.test_count} ===================")
-        device = connect_device(args.serial)
-
-        if args.mode == 'UGS':
-            test_result = execute_test_ugs(device, args.wifi_ssid)
-        elif args.mode == 'BCS':
-            test_result = execute_test_bcs(device, args.wifi_ssid)
-        elif args.mode == 'ZTS':
-            test_result = execute_test_zts(device, args.device_name)
-        elif args.mode == 'Matter':
-            test_result = execute_test_matter(device, args.wifi_ssid, args.pairing_code_11d)
-
-        if test_result:
-            success_cnt += 1
-            time.sleep(3)
-            execute_factory_reset(device, args.device_name)
-            time.sleep(3)
-        else:
-            failure_cnt += 1
+    if args.metrics_port is not None:
+        metrics = Metrics()
+        metrics.set("ffs_start_time_seconds", time.time())
+        try:
+            start_metrics_server(args.metrics_host, args.metrics_port)
+        except OSError as e:
+            logger.error(f"Could not serve metrics on {args.metrics_host}:{args.metrics_port}: {e}")
+            return
 
-        logger.info(f"=======================================================")
-        logger.info(f" Execute Summary:")
-        logger.info(f" Total executed {args.mode} times: {success_cnt + failure_cnt} / {args.test_count}")
-        logger.info(f" Total successful {args.mode}: {success_cnt}")
-        logger.info(f" Total failed {args.mode}: {failure_cnt}")
-        logger.info(f"=======================================================")
+    time_str = time.strftime("%Y-%m-%d_%H_%M_%S", time.localtime())
+    timing_file = args.timing_file or f"timing_{run_name}_{time_str}.jsonl"
+    if args.soak:
+        step_recorder = StepRecorder(timing_file, args.log_max_mb, args.log_rotate_when)
+    else:
+        step_recorder = StepRecorder(timing_file)
+
+    if args.results_db:
+        results_store = ResultStore(args.results_db, run_id=time_str)
+
+    phase_timeouts = PhaseTimeouts(results_store, args.timeout_margin, args.timeout_floor,
+                                   parse_pinned_timeouts(args.pin_timeout), adaptive=not args.static_timeouts)
+
+    if not args.no_artifacts:
+        artifact_pipeline = ArtifactPipeline(args.artifact_dir, args.artifact_budget_mb * 1024 * 1024)
+
+    scheduler = ModeScheduler(modes, test_count, budget_sec, batch)
+    if len(modes) > 1 or budget_sec:
+        budget_str = f"{budget_sec / 60:g} minutes" if budget_sec else "no time budget"
+        logger.info(f"Scenario: {', '.join(f'{mode} x{scheduler.weights[mode]:g}' for mode in modes)}, {budget_str}")
+    if args.soak:
+        soak_monitor = SoakMonitor(scheduler, args.checkpoint, args.soak_window, args.soak_report_min * 60)
+        try:
+            soak_monitor.resume()
+        except (OSError, ValueError, KeyError):
+            logger.error(f"Could not resume from {args.checkpoint}, starting from zero")
+            logger.error(traceback.format_exc())
+        logger.info(f"Soak run, stop it with Ctrl+C. Checkpoints go to {args.checkpoint}.")
+    signal.signal(signal.SIGINT, scheduler.request_stop)
+    signal.signal(signal.SIGTERM, scheduler.request_stop)
+    try:
+        if len(phones) == 1:
+            run_worker(phones[0], scheduler)
+        else:
+            logger.info(f"Running {run_name} tests on {len(phones)} phones: {', '.join(phone.serial for phone in phones)}")
+            # Daemon threads, so that an abort does not wait for the flows still running on the other phones
+            workers = [threading.Thread(target=run_worker, args=(phone, scheduler), name=f"phone-{phone.serial}", daemon=True)
+                       for phone in phones]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+    except KeyboardInterrupt:
+        logger.info("Aborted.")
+        scheduler.stop()
+    finally:
+        if soak_monitor is not None:
+            soak_monitor.write_checkpoint()
+            soak_monitor.log_report()
+        scheduler.log_summary()
+        if scheduler.popups:
+            logger.info(f"Popups dismissed: {', '.join(f'{name}={count}' for name, count in scheduler.popups.items())}")
+        step_recorder.log_report()
+        step_recorder.close()
+        if artifact_pipeline is not None:
+            artifact_pipeline.close()
+        if results_store is not None:
+            results_store.close()
 
 if __name__ == "__main__":
     main()
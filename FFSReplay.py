@@ -0,0 +1,539 @@
+import argparse
+import collections
+import json
+import logging
+import os
+import shlex
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+import FFSAutomation as ffs
+
+# Constants
+SCREEN_WIDTH = 1080
+SCREEN_HEIGHT = 2400
+ROW_HEIGHT = 120
+FAKE_WAIT_TIMEOUT_SEC = 20
+FAKE_POLL_INTERVAL_SEC = 0.01
+LAUNCHER_PACKAGE_NAME = "com.android.launcher"
+BENCHMARK_MODES = ["UGS", "BCS", "ZTS", "Matter", "FactoryReset"]
+
+# Scenario format, shared by the built-in scenario and the JSON files given with --scenario:
+#   start:   screen shown after app_start
+#   deeplinks: optional uri prefix -> screen opened by "am start -d <uri>"
+#   screens: name -> {"hierarchy": "<file recorded with --record_screen>"} or {"nodes": [...]},
+#            plus "on" transitions and an optional "after" transition
+# A node is {"resource-id", "text", "content-desc", "class", "scrollable", "children", "if": "<flag>"}.
+# A transition is {"tap": <selector or xpath>} | {"swipe": true} | {"back": true} | {"action": true},
+# with "to": <screen>, "delay": <seconds>, "set"/"clear": [<flags>]
+def n(resource_id="", text="", desc="", cls="android.view.View", children=(), scrollable=False, flag=None):
+    node = {"resource-id": resource_id, "text": text, "content-desc": desc, "class": cls}
+    if children:
+        node["children"] = list(children)
+    if scrollable:
+        node["scrollable"] = True
+    if flag:
+        node["if"] = flag
+    return node
+
+def tap(selector, to=None, delay=0.5, **kwargs):
+    return dict(tap=selector, to=to, delay=delay, **kwargs)
+
+def after(delay, to, **kwargs):
+    return dict(delay=delay, to=to, **kwargs)
+
+HOME_NODES = [
+    n("com.amazon.dee.app:id/home_header_quick_add", desc="Add"),
+    n("com.amazon.dee.app:id/tab_channels_device_icon", desc="Devices"),
+]
+
+def progress_screen(text, delay, to, **kwargs):
+    nodes = [n("mosaic.base_text", text)]
+    return {"nodes": nodes, "after": after(delay, to, **kwargs)}
+
+BUILTIN_SCENARIO = {
+    "start": "home",
+    "deeplinks": {"alexa://device/": "device_page"},
+    "screens": {
+        "launching": {"nodes": [], "after": after(3.0, "home")},
+        "home": {"nodes": HOME_NODES, "on": [
+            tap({"resourceId": "com.amazon.dee.app:id/home_header_quick_add"}, "add_menu", 0.5),
+            tap({"resourceId": "com.amazon.dee.app:id/tab_channels_device_icon"}, "devices", 0.8),
+        ]},
+        "add_menu": {"nodes": HOME_NODES + [n("1-primary", "Add Device")], "on": [
+            tap({"resourceId": "1-primary"}, "add_landing", 1.0),
+        ]},
+        "add_landing": {"nodes": [n("AddDevicesLandingPage", cls="android.widget.ScrollView", scrollable=True, children=[
+            n("DeviceTypeRow_Development Device-primary", "Development Device"),
+            n("DeviceTypeRow_Other-primary", "Other"),
+        ])], "on": [
+            tap({"resourceId": "DeviceTypeRow_Development Device-primary"}, "brand_selection", 1.0),
+            tap({"resourceId": "DeviceTypeRow_Other-primary"}, "matter_grid", 1.0),
+        ]},
+        "brand_selection": {"nodes": [n("DiscoveryBrandSelectionPage", children=[n("DeviceBrandRow_ACK=0-primary", "ACK")])], "on": [
+            tap({"resourceId": "DeviceBrandRow_ACK=0-primary"}, "ack_power_check", 1.0),
+        ]},
+        "ack_power_check": {"nodes": [n("mosaic.pages.InstructionalPage-title"), n("mosaic.base_text", "Yes")], "on": [
+            tap({"resourceId": "mosaic.base_text", "text": "Yes"}, "ack_code_choice", 0.0),
+        ]},
+        "ack_code_choice": {"nodes": [
+            n("mosaic.pages.InstructionalPage-title"),
+            n("mosaic.base_text", "Don't Have A Code?"),
+            n("mosaic.pages.InstructionalPage-footer-primary-btn", "Scan Code"),
+        ], "on": [
+            tap({"resourceId": "mosaic.base_text", "text": "Don't Have A Code?"}, "ugs_pairing_mode", 0.0),
+            tap({"resourceId": "mosaic.pages.InstructionalPage-footer-primary-btn"}, "bcs_scan", 1.0),
+        ]},
+        "ugs_pairing_mode": {"nodes": [
+            n("mosaic.pages.InstructionalPage-title"),
+            n("mosaic.pages.InstructionalPage-footer-primary-btn", "Next"),
+        ], "on": [
+            tap({"resourceId": "mosaic.pages.InstructionalPage-footer-primary-btn"}, "ugs_looking", 1.0),
+        ]},
+        "ugs_looking": {"nodes": [n("mosaic.pages.ConfirmationPage-title"), n("mosaic.base_text", "Looking for your ACK development device")],
+                        "after": after(8.0, "ugs_connecting")},
+        "ugs_connecting": progress_screen("Connecting to your ACK development device", 6.0, "ugs_wifi_list"),
+        "ugs_wifi_list": {"nodes": [
+            n("Mosaic.radio_list_item-primary", ffs.SAVED_WIFI_SSID),
+            n(text="Next", cls="android.widget.Button"),
+        ], "on": [
+            tap('//*[@text="Next"]', "registering", 1.0),
+        ]},
+        "bcs_scan": {"nodes": [n("mosaic.text", "Scan the 2D barcode for your development device")], "after": after(3.0, "bcs_looking")},
+        "bcs_looking": progress_screen("Looking for your ACK development device", 8.0, "bcs_connecting"),
+        "bcs_connecting": progress_screen("Connecting to your ACK development device", 6.0, "registering"),
+        "registering": progress_screen("Connecting your ACK development device to ", 10.0, "new_device_found", set=["device_added"]),
+        "new_device_found": {"nodes": [n("NewDeviceFoundPage")]},
+        "matter_grid": {"nodes": [n("mosaic-tiles_grid_0_genericMatter", "Matter")], "on": [
+            tap({"resourceId": "mosaic-tiles_grid_0_genericMatter"}, "matter_logo", 1.0),
+        ]},
+        "matter_logo": {"nodes": [n("mosaic.base_text", "Does your device have a Matter logo?"), n("mosaic.base_text", "YES")], "on": [
+            tap({"resourceId": "mosaic.base_text", "text": "YES"}, "matter_power_check", 1.0),
+        ]},
+        "matter_power_check": {"nodes": [n("power-on-check-footer-primary-btn", "Yes")], "on": [
+            tap({"resourceId": "power-on-check-footer-primary-btn"}, "matter_locate_qr", 1.0),
+        ]},
+        "matter_locate_qr": {"nodes": [n("locate-qr-code-page-footer-secondary-btn", "Try Numeric Code Instead?")], "on": [
+            tap({"resourceId": "locate-qr-code-page-footer-secondary-btn"}, "matter_locate_numeric", 1.0),
+        ]},
+        "matter_locate_numeric": {"nodes": [n("locate-numerical-code-page-footer-primary-btn", "Enter Code")], "on": [
+            tap({"resourceId": "locate-numerical-code-page-footer-primary-btn"}, "matter_input_code", 1.0),
+        ]},
+        "matter_input_code": {"nodes": [
+            n("input-numeric-code-page-BodyText"),
+            n(cls="android.widget.ScrollView", children=[n(cls="android.view.ViewGroup", children=[n(cls="android.view.ViewGroup")])]),
+            n("input-numeric-code-page-footer-primary-btn", "Next"),
+        ], "on": [
+            tap({"resourceId": "input-numeric-code-page-footer-primary-btn"}, "matter_looking", 1.0),
+        ]},
+        "matter_looking": progress_screen("Looking for your device", 6.0, "matter_connecting"),
+        "matter_connecting": progress_screen("Connecting to your device", 5.0, "matter_network"),
+        "matter_network": progress_screen("Connecting your device to the network", 5.0, "matter_ready"),
+        "matter_ready": progress_screen("Alexa is getting your device ready", 4.0, "matter_complete", set=["device_added"]),
+        "matter_complete": {"nodes": [n("commissioning-complete-page")]},
+        "devices": {"nodes": HOME_NODES + [
+            n("com.amazon.dee.app:id/fab", desc="Alexa"),
+            n(cls="android.widget.ScrollView", scrollable=True, children=[n("mosaic.text", ffs.DEFAULT_DEVICE_NAME, flag="device_added")]),
+        ], "on": [
+            tap({"resourceId": "com.amazon.dee.app:id/home_header_quick_add"}, "add_menu", 0.5),
+            tap({"resourceId": "com.amazon.dee.app:id/fab"}, "alexa_input", 0.0),
+            tap({"resourceId": "mosaic.text", "text": ffs.DEFAULT_DEVICE_NAME}, "device_page", 1.5),
+        ]},
+        "alexa_input": {"nodes": [n(cls="android.widget.EditText")], "on": [
+            {"action": True, "to": "devices", "delay": 0.5},
+            {"action": True, "delay": 10.0, "set": ["device_added"]},
+        ]},
+        "device_page": {"nodes": [n(desc="Settings", children=[n(cls="android.widget.ImageView")])], "on": [
+            tap('//*[@content-desc="Settings"]/android.widget.ImageView[1]', "device_settings", 1.0),
+        ]},
+        "device_settings": {"nodes": [n(desc="Delete", children=[n(cls="android.widget.ImageView")])], "on": [
+            tap('//*[@content-desc="Delete"]/android.widget.ImageView[1]', "delete_dialog", 0.5),
+        ]},
+        "delete_dialog": {"nodes": [n("android:id/button1", "DELETE", cls="android.widget.Button")], "on": [
+            tap('//*[@resource-id="android:id/button1"]', "devices", 1.0, clear=["device_added"]),
+        ]},
+    },
+}
+
+def load_scenario(path):
+    with open(path) as f:
+        scenario = json.load(f)
+    base_dir = os.path.dirname(os.path.abspath(path))
+    for screen in scenario["screens"].values():
+        if "hierarchy" in screen:
+            with open(os.path.join(base_dir, screen["hierarchy"])) as f:
+                screen["xml"] = f.read()
+    return scenario
+
+def render_nodes(parent, nodes, flags, left, top, right):
+    y = top
+    for node in nodes:
+        if node.get("if") and node["if"] not in flags:
+            continue
+        children = node.get("children", [])
+        height = ROW_HEIGHT * max(1, len(children))
+        element = ET.SubElement(parent, "node", {
+            "class": node.get("class", "android.view.View"),
+            "package": ffs.ALEXA_APP_PACKAGE_NAME,
+            "resource-id": node.get("resource-id", ""),
+            "text": node.get("text", ""),
+            "content-desc": node.get("content-desc", ""),
+            "clickable": "true",
+            "scrollable": "true" if node.get("scrollable") else "false",
+            "bounds": f"[{left},{y}][{right},{y + height}]",
+        })
+        render_nodes(element, children, flags, left + 10, y, right - 10)
+        y += height
+
+def render_screen(screen, flags):
+    if "xml" in screen:
+        return screen["xml"]
+    root = ET.Element("hierarchy", {"rotation": "0"})
+    frame = ET.SubElement(root, "node", {
+        "class": "android.widget.FrameLayout",
+        "package": ffs.ALEXA_APP_PACKAGE_NAME,
+        "resource-id": "", "text": "", "content-desc": "",
+        "bounds": f"[0,0][{SCREEN_WIDTH},{SCREEN_HEIGHT}]",
+    })
+    render_nodes(frame, screen.get("nodes", []), flags, 0, 0, SCREEN_WIDTH)
+    return ET.tostring(root, encoding="unicode")
+
+# Fake uiautomator2 device
+class FakeUiObjectNotFoundError(Exception):
+    pass
+
+ShellResponse = collections.namedtuple("ShellResponse", ["output", "exit_code"])
+
+class FakeScroll:
+    def __init__(self, device, selector):
+        self.device = device
+        self.selector = selector
+
+    def to(self, **selector):
+        self.device._rpc("scroll")
+        return self.device._snapshot().exists(selector)
+
+    def toEnd(self):
+        self.device._rpc("scroll")
+        return True
+
+    def toBeginning(self):
+        self.device._rpc("scroll")
+        return True
+
+    def forward(self):
+        # Every row of the fake lists is on screen, so there is nothing left to scroll to
+        self.device._rpc("scroll")
+        return False
+
+class FakeUiObject:
+    def __init__(self, device, selector):
+        self.device = device
+        self.selector = selector
+
+    @property
+    def exists(self):
+        self.device._rpc("exists")
+        return self.device._snapshot().exists(self.selector)
+
+    @property
+    def scroll(self):
+        return FakeScroll(self.device, self.selector)
+
+    def wait(self, timeout=FAKE_WAIT_TIMEOUT_SEC):
+        self.device._rpc("wait")
+        return self.device._wait_until(lambda snap: snap.exists(self.selector), timeout)
+
+    def wait_gone(self, timeout=FAKE_WAIT_TIMEOUT_SEC):
+        self.device._rpc("wait_gone")
+        return self.device._wait_until(lambda snap: not snap.exists(self.selector), timeout)
+
+    def get_text(self):
+        self.device._rpc("get_text")
+        text = self.device._snapshot().get_text(self.selector)
+        if text is None:
+            raise FakeUiObjectNotFoundError(self.selector)
+        return text
+
+    def click(self, timeout=FAKE_WAIT_TIMEOUT_SEC):
+        # Like uiautomator2, wait for the element before clicking it
+        self.device._rpc("click")
+        if not self.device._wait_until(lambda snap: snap.exists(self.selector), timeout):
+            raise FakeUiObjectNotFoundError(self.selector)
+        self.device._tap_at(self.device._snapshot().center(self.selector))
+
+class FakeDevice:
+    def __init__(self, scenario=BUILTIN_SCENARIO, serial="fake-0", time_scale=1.0, rpc_latency=0.0):
+        self.scenario = scenario
+        self.serial = serial
+        self.time_scale = time_scale
+        self.rpc_latency = rpc_latency
+        self.screen = "stopped"
+        self.screen_seen = False
+        self.flags = set()
+        self.pending = []
+        self.rpc_counts = collections.Counter()
+        self.step_rpc_counts = collections.Counter()
+
+    # Scenario playback
+    def _rpc(self, kind):
+        self.rpc_counts[kind] += 1
+        step = getattr(ffs._worker, "step", None)
+        flow = getattr(ffs._worker, "flow", None)
+        self.step_rpc_counts[(flow, step[0] if step else None)] += 1
+        if self.rpc_latency:
+            time.sleep(self.rpc_latency)
+        self._advance()
+
+    def _advance(self):
+        # A screen only moves on by itself once it has been observed, so that with
+        # --time_scale 0 every intermediate page is still seen by the flows
+        now = time.time()
+        is_due = lambda item: item[0] <= now and (self.screen_seen or not item[2])
+        due = sorted((item for item in self.pending if is_due(item)), key=lambda item: item[0])
+        self.pending = [item for item in self.pending if not is_due(item)]
+        for _, transition, _ in due:
+            self._apply(transition)
+
+    def _apply(self, transition):
+        self.flags.update(transition.get("set", []))
+        self.flags.difference_update(transition.get("clear", []))
+        if transition.get("to"):
+            self._enter(transition["to"])
+
+    def _enter(self, screen_name):
+        # Screen changes still scheduled for the old screen are dropped, pending flag changes are kept
+        self.pending = [item for item in self.pending if not item[1].get("to")]
+        self.screen = screen_name
+        self.screen_seen = False
+        screen = self.scenario["screens"].get(screen_name, {})
+        if "after" in screen:
+            self._schedule(screen["after"], after_seen=True)
+
+    def _schedule(self, transition, after_seen=False):
+        delay = transition.get("delay", 0.0) * self.time_scale
+        if delay <= 0 and not after_seen:
+            self._apply(transition)
+        else:
+            self.pending.append((time.time() + delay, transition, after_seen))
+
+    def _fire(self, kind):
+        screen = self.scenario["screens"].get(self.screen, {})
+        for transition in screen.get("on", []):
+            if transition.get(kind):
+                self._schedule(transition)
+
+    def _xml(self):
+        if self.screen == "stopped":
+            return render_screen({"nodes": []}, self.flags)
+        return render_screen(self.scenario["screens"][self.screen], self.flags)
+
+    def _snapshot(self):
+        self.screen_seen = True
+        return ffs.UISnapshot(self._xml())
+
+    def _wait_until(self, predicate, timeout):
+        deadline = time.time() + timeout
+        while True:
+            self._advance()
+            if predicate(self._snapshot()):
+                return True
+            if time.time() >= deadline:
+                return False
+            time.sleep(FAKE_POLL_INTERVAL_SEC)
+
+    def _tap_at(self, point):
+        if point is None or self.screen == "stopped":
+            return
+        snap = self._snapshot()
+        x, y = point
+        for transition in self.scenario["screens"][self.screen].get("on", []):
+            if "tap" not in transition:
+                continue
+            for node in snap.find(transition["tap"]):
+                match = ffs._BOUNDS.match(node.get("bounds", ""))
+                x1, y1, x2, y2 = (int(v) for v in match.groups())
+                if x1 <= x <= x2 and y1 <= y <= y2:
+                    self._schedule(transition)
+                    return
+
+    # uiautomator2 surface used by FFSAutomation
+    def __call__(self, **selector):
+        return FakeUiObject(self, selector)
+
+    def xpath(self, expr):
+        return FakeUiObject(self, expr)
+
+    def exists(self, **selector):
+        return self(**selector).exists
+
+    @property
+    def info(self):
+        self._rpc("info")
+        return {"productName": "fake", "sdkInt": 33, "displayWidth": SCREEN_WIDTH, "displayHeight": SCREEN_HEIGHT}
+
+    def dump_hierarchy(self, *args, **kwargs):
+        self._rpc("dump_hierarchy")
+        self.screen_seen = True
+        return self._xml()
+
+    def screenshot(self, format="raw"):
+        self._rpc("screenshot")
+        return b""
+
+    def click(self, x, y):
+        self._rpc("click")
+        self._tap_at((x, y))
+
+    def swipe_ext(self, direction, *args, **kwargs):
+        self._rpc("swipe")
+        self._fire("swipe")
+
+    def press(self, key):
+        self._rpc("press")
+        if key == "back":
+            screen = self.scenario["screens"].get(self.screen, {})
+            if any(transition.get("back") for transition in screen.get("on", [])):
+                self._fire("back")
+            elif self.screen != "stopped":
+                self._enter(self.scenario["start"])
+
+    def clear_text(self):
+        self._rpc("clear_text")
+
+    def send_keys(self, text, *args, **kwargs):
+        self._rpc("send_keys")
+
+    def send_action(self, *args, **kwargs):
+        self._rpc("send_action")
+        self._fire("action")
+
+    def app_start(self, package_name, *args, **kwargs):
+        self._rpc("app_start")
+        self._enter("launching" if "launching" in self.scenario["screens"] else self.scenario["start"])
+
+    def app_stop(self, package_name):
+        self._rpc("app_stop")
+        self.pending = [item for item in self.pending if not item[1].get("to")]
+        self.screen = "stopped"
+
+    def shell(self, cmdargs, *args, **kwargs):
+        self._rpc("shell")
+        cmdargs = shlex.split(cmdargs) if isinstance(cmdargs, str) else list(cmdargs)
+        if cmdargs[:2] == ["am", "start"] and "-d" in cmdargs:
+            uri = cmdargs[cmdargs.index("-d") + 1]
+            for prefix, screen_name in self.scenario.get("deeplinks", {}).items():
+                if uri.startswith(prefix):
+                    self._enter(screen_name)
+                    return ShellResponse("Status: ok\n", 0)
+        return ShellResponse("Error: Activity not started, unable to resolve Intent\n", 1)
+
+    def app_current(self):
+        self._rpc("app_current")
+        package = LAUNCHER_PACKAGE_NAME if self.screen == "stopped" else ffs.ALEXA_APP_PACKAGE_NAME
+        return {"package": package, "activity": ".MainActivity"}
+
+# Benchmark
+def run_flow(device, mode, args):
+    if mode == "UGS":
+        return ffs.execute_test_ugs(device, args.wifi_ssid)
+    elif mode == "BCS":
+        return ffs.execute_test_bcs(device, args.wifi_ssid)
+    elif mode == "ZTS":
+        device.flags.discard("device_added")
+        return ffs.execute_test_zts(device, args.device_name)
+    elif mode == "Matter":
+        return ffs.execute_test_matter(device, args.wifi_ssid, args.pairing_code_11d)
+    elif mode == "FactoryReset":
+        device.flags.add("device_added")
+        return ffs.execute_factory_reset(device, args.device_name)
+    return False
+
+def benchmark_mode(mode, scenario, args):
+    device = FakeDevice(scenario, time_scale=args.time_scale, rpc_latency=args.rpc_latency)
+    ffs._worker.serial = device.serial
+    ffs.step_recorder = ffs.StepRecorder(os.devnull)
+    durations = []
+    passed = 0
+    for i in range(args.iterations):
+        ffs._worker.iteration = i + 1
+        start = time.time()
+        if run_flow(device, mode, args):
+            passed += 1
+        durations.append(time.time() - start)
+    ffs.step_recorder.close()
+    return device, durations, passed, ffs.step_recorder.durations
+
+def log_benchmark(mode, device, durations, passed, step_durations, iterations):
+    print(f"=======================================================")
+    print(f" {mode}: {passed}/{iterations} passed, wall p50={ffs.percentile(durations, 50):.3f}s "
+          f"p90={ffs.percentile(durations, 90):.3f}s mean={sum(durations) / len(durations):.3f}s")
+    rpc_total = sum(device.rpc_counts.values())
+    rpc_details = ", ".join(f"{kind}={count / iterations:.1f}" for kind, count in device.rpc_counts.most_common())
+    print(f" RPCs per iteration: {rpc_total / iterations:.1f} ({rpc_details})")
+    print(f"   {'step':<30} {'p50':>8} {'p90':>8} {'rpc/iter':>9}")
+    for (flow, step), values in step_durations.items():
+        if flow != mode:
+            continue
+        rpcs = device.step_rpc_counts.get((flow, step if step != "total" else None), 0)
+        if step == "total":
+            rpcs = sum(count for (rpc_flow, _), count in device.step_rpc_counts.items() if rpc_flow == flow)
+        print(f"   {step:<30} {ffs.percentile(values, 50):8.3f} {ffs.percentile(values, 90):8.3f} {rpcs / iterations:9.1f}")
+
+def record_screen(serial, path):
+    device = ffs.connect_device(serial)
+    with open(path, "w") as f:
+        f.write(device.dump_hierarchy())
+    print(f"Saved the current screen of {serial} to {path}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay the FFS flows against recorded hierarchy dumps and benchmark the automation without a phone.")
+    parser.add_argument('--mode', type=str, default=",".join(BENCHMARK_MODES), help=f'Comma-separated flows to benchmark. Valid values are: {", ".join(BENCHMARK_MODES)}.')
+    parser.add_argument('--iterations', type=int, default=200, help='Number of runs per flow.')
+    parser.add_argument('--scenario', type=str, default=None, help='A scenario JSON file with recorded screens. Uses the built-in scenario when omitted.')
+    parser.add_argument('--time_scale', type=float, default=0.0, help='Multiplier for the scripted screen delays. 0 makes the phone answer instantly, so the wall time is the automation overhead alone.')
+    parser.add_argument('--rpc_latency', type=float, default=0.0, help='Simulated latency of every uiautomator2 call, in seconds.')
+    parser.add_argument('--poll_interval', type=float, default=None, help='Overrides WAIT_POLL_INTERVAL_SEC of the flows.')
+    parser.add_argument('--warm_start', action='store_true', help='Benchmark with the warm app start.')
+    parser.add_argument('--wifi_ssid', type=str, default=ffs.SAVED_WIFI_SSID, help='The SSID selected by the UGS flow.')
+    parser.add_argument('--device_name', type=str, default=ffs.DEFAULT_DEVICE_NAME, help='The name of the device on Alexa App.')
+    parser.add_argument('--pairing_code_11d', type=int, default=12345678901, help='The 11-digits Matter pairing code')
+    parser.add_argument('--reset_intent', type=str, default=None, help='Benchmark the FactoryReset flow with this --reset_intent, e.g. "-a android.intent.action.VIEW -d alexa://device/{device_name_url}".')
+    parser.add_argument('--verbose', action='store_true', help='Show the flow logs.')
+    parser.add_argument('--record_screen', type=str, default=None, help='Save the current screen of the phone given by --serial to this file and exit.')
+    parser.add_argument('--serial', type=str, default=ffs.ANDROID_SERIAL, help='The serial number of the Android device used by --record_screen.')
+
+    args = parser.parse_args(argv)
+
+    if args.record_screen:
+        record_screen(args.serial, args.record_screen)
+        return
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    ffs.logger.setLevel(logging.INFO if args.verbose else logging.CRITICAL)
+    ffs.warm_start_enabled = args.warm_start
+    ffs.factory_reset_intent = args.reset_intent
+    if args.poll_interval is not None:
+        ffs.WAIT_POLL_INTERVAL_SEC = args.poll_interval
+
+    scenario = load_scenario(args.scenario) if args.scenario else BUILTIN_SCENARIO
+    failed_modes = []
+    for mode in args.mode.split(','):
+        mode = mode.strip()
+        if mode not in BENCHMARK_MODES:
+            print(f"Skipping unknown mode {mode}")
+            continue
+        device, durations, passed, step_durations = benchmark_mode(mode, scenario, args)
+        log_benchmark(mode, device, durations, passed, step_durations, args.iterations)
+        if passed < args.iterations:
+            failed_modes.append(mode)
+
+    # A regression in a flow must fail the run, not just show up in the report
+    if failed_modes:
+        print(f"Flows with failed runs: {', '.join(failed_modes)}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
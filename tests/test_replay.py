@@ -0,0 +1,76 @@
+import json
+
+import pytest
+
+import FFSAutomation as ffs
+import FFSReplay
+
+ITERATIONS = 3
+
+@pytest.fixture(autouse=True)
+def restore_flow_globals(monkeypatch):
+    # main() overrides these module globals of the flows
+    monkeypatch.setattr(ffs, "WAIT_POLL_INTERVAL_SEC", ffs.WAIT_POLL_INTERVAL_SEC)
+    monkeypatch.setattr(ffs, "warm_start_enabled", ffs.warm_start_enabled)
+    monkeypatch.setattr(ffs, "factory_reset_intent", ffs.factory_reset_intent)
+    monkeypatch.setattr(ffs, "step_recorder", ffs.step_recorder)
+
+@pytest.mark.parametrize("mode", FFSReplay.BENCHMARK_MODES)
+def test_every_run_passes(mode):
+    args = ["--mode", mode, "--iterations", str(ITERATIONS), "--time_scale", "0", "--poll_interval", "0.01"]
+    assert FFSReplay.main(args) == 0
+
+def test_warm_start_passes():
+    args = ["--mode", "UGS", "--iterations", str(ITERATIONS), "--time_scale", "0", "--poll_interval", "0.01", "--warm_start"]
+    assert FFSReplay.main(args) == 0
+
+def test_failed_run_fails_the_benchmark(monkeypatch):
+    monkeypatch.setattr(FFSReplay, "run_flow", lambda device, mode, args: False)
+    args = ["--mode", "BCS", "--iterations", "1", "--time_scale", "0"]
+    assert FFSReplay.main(args) == 1
+
+def drop_taps(monkeypatch, screen, count):
+    # The phone ignores the first taps on a screen, like a tap lost while the page is still loading
+    dropped = []
+    tap_at = FFSReplay.FakeDevice._tap_at
+    def lossy_tap_at(device, point):
+        if device.screen == screen and len(dropped) < count:
+            dropped.append(point)
+            return
+        tap_at(device, point)
+    monkeypatch.setattr(FFSReplay.FakeDevice, "_tap_at", lossy_tap_at)
+    return dropped
+
+def run_ugs(monkeypatch, tmp_path):
+    monkeypatch.setattr(ffs, "WAIT_POLL_INTERVAL_SEC", 0.01)
+    monkeypatch.setattr(ffs, "RETRY_BACKOFF_SEC", 0.0)
+    tap_until = ffs.tap_until
+    monkeypatch.setattr(ffs, "tap_until", lambda *args, **kwargs: tap_until(*args, **dict(kwargs, timeout_sec=0.2)))
+    recorder = ffs.StepRecorder(str(tmp_path / "timing.jsonl"))
+    monkeypatch.setattr(ffs, "step_recorder", recorder)
+    device = FFSReplay.FakeDevice(time_scale=0)
+    ffs._worker.serial = device.serial
+    ffs._worker.retries = 0
+    ffs._worker.failure_class = None
+    result = ffs.execute_test_ugs(device, ffs.SAVED_WIFI_SSID)
+    recorder.close()
+    with open(recorder.path) as f:
+        records = [json.loads(line) for line in f]
+    return result, recorder, records
+
+def test_lost_tap_is_retried(monkeypatch, tmp_path):
+    drop_taps(monkeypatch, "ugs_pairing_mode", 1)
+    result, recorder, records = run_ugs(monkeypatch, tmp_path)
+    assert result
+    assert ffs._worker.retries == 1
+    assert [record["outcome"] for record in records if record["step"] == "confirm_next"] == ["retry", "ok"]
+    # Only the successful attempt counts towards the step percentiles
+    assert len(recorder.durations[("UGS", "confirm_next")]) == 1
+
+def test_lost_taps_fail_as_automation(monkeypatch, tmp_path):
+    drop_taps(monkeypatch, "ugs_pairing_mode", ffs.step_retry_attempts)
+    result, recorder, records = run_ugs(monkeypatch, tmp_path)
+    assert not result
+    assert ffs._worker.failure_class == ffs.FAILURE_AUTOMATION
+    assert ffs._worker.last_step == "confirm_next"
+    assert [record["outcome"] for record in records if record["step"] == "confirm_next"] == ["retry", "retry", "fail"]